@@ -2,6 +2,7 @@ interface ResultActionsProps {
   imageUrl: string;
   onReedit: () => void;
   onReset: () => void;
+  onDownloadAll?: () => void;
 }
 
 function downloadImage(imageUrl: string, format: 'png' | 'jpeg') {
@@ -29,7 +30,7 @@ async function copyToClipboard(imageUrl: string) {
   }
 }
 
-export function ResultActions({ imageUrl, onReedit, onReset }: ResultActionsProps) {
+export function ResultActions({ imageUrl, onReedit, onReset, onDownloadAll }: ResultActionsProps) {
   return (
     <div className="mt-6 flex flex-wrap gap-3">
       <button
@@ -53,6 +54,15 @@ export function ResultActions({ imageUrl, onReedit, onReset }: ResultActionsProp
       >
         クリップボードにコピー
       </button>
+      {onDownloadAll && (
+        <button
+          type="button"
+          onClick={onDownloadAll}
+          className="rounded-full border border-slate-500 px-5 py-2 text-sm font-semibold text-slate-100 hover:bg-slate-800"
+        >
+          最近の結果をZIPでダウンロード
+        </button>
+      )}
       <button
         type="button"
         onClick={onReedit}
@@ -12,6 +12,9 @@ export type PollResponse = {
   status: 'processing' | 'success' | 'failed';
   result_url?: string;
   error?: string;
+  request_id?: string;
+  estimated_completion_at?: string | null;
+  retry_after_ms?: number | null;
 };
 
 export type MeResponse = {
@@ -44,6 +47,29 @@ export type HistoryResponse = {
   consumptions: ConsumptionLog[];
 };
 
+export type UsageTotals = {
+  credits_purchased: number;
+  amount_total_jpy: number;
+  charge_count: number;
+  credits_consumed: number;
+  generation_count: number;
+  credits_refunded: number;
+  refund_count: number;
+};
+
+export type DailyUsageLog = UsageTotals & {
+  day: string;
+};
+
+export type SummaryResponse = {
+  uid: string;
+  email?: string | null;
+  credits: number;
+  days: number;
+  totals: UsageTotals;
+  daily: DailyUsageLog[];
+};
+
 export type CheckoutSessionResponse = {
   url: string;
 };
@@ -71,6 +97,7 @@ type FetchOptions = {
   method?: 'GET' | 'POST';
   body?: unknown;
   idToken?: string | null;
+  idempotencyKey?: string;
 };
 
 async function fetchWithAuth<T>(path: string, options: FetchOptions = {}): Promise<T> {
@@ -82,6 +109,10 @@ async function fetchWithAuth<T>(path: string, options: FetchOptions = {}): Promi
     headers.Authorization = `Bearer ${options.idToken}`;
   }
 
+  if (options.idempotencyKey) {
+    headers['Idempotency-Key'] = options.idempotencyKey;
+  }
+
   const response = await fetch(`${API_BASE_URL}${path}`, {
     method: options.method ?? 'GET',
     headers,
@@ -97,23 +128,30 @@ export function pollResult(requestId: string): Promise<PollResponse> {
   });
 }
 
-export function generateImage(payload: EditRequestPayload, idToken: string): Promise<EditResponse> {
+export function generateImage(
+  payload: EditRequestPayload,
+  idToken: string,
+  idempotencyKey?: string
+): Promise<EditResponse> {
   return fetchWithAuth<EditResponse>('/api/generate', {
     method: 'POST',
     body: payload,
-    idToken
+    idToken,
+    idempotencyKey
   });
 }
 
 export function createCheckoutSession(
   priceId: string,
   quantity: number,
-  idToken: string
+  idToken: string,
+  idempotencyKey?: string
 ): Promise<CheckoutSessionResponse> {
   return fetchWithAuth<CheckoutSessionResponse>('/api/payment/create-checkout-session', {
     method: 'POST',
     body: { price_id: priceId, quantity },
-    idToken
+    idToken,
+    idempotencyKey
   });
 }
 
@@ -124,3 +162,21 @@ export function fetchMe(idToken: string): Promise<MeResponse> {
 export function fetchHistory(idToken: string): Promise<HistoryResponse> {
   return fetchWithAuth<HistoryResponse>('/api/me/history', { method: 'GET', idToken });
 }
+
+export async function downloadResultsZip(idToken: string, requestIds: string[] = []): Promise<Blob> {
+  const params = new URLSearchParams();
+  requestIds.forEach((requestId) => params.append('request_ids', requestId));
+  const query = params.toString();
+  const response = await fetch(`${API_BASE_URL}/api/me/results.zip${query ? `?${query}` : ''}`, {
+    headers: { Authorization: `Bearer ${idToken}` }
+  });
+  if (!response.ok) {
+    const message = await response.text();
+    throw new ApiError(message || 'サーバーでエラーが発生しました。', response.status);
+  }
+  return response.blob();
+}
+
+export function fetchSummary(idToken: string, days = 30): Promise<SummaryResponse> {
+  return fetchWithAuth<SummaryResponse>(`/api/me/summary?days=${days}`, { method: 'GET', idToken });
+}
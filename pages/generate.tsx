@@ -7,7 +7,7 @@ import { InstructionChips } from '@/components/InstructionChips';
 import { ProcessingModal } from '@/components/ProcessingModal';
 import { ResultActions } from '@/components/ResultActions';
 import { validatePrompt } from '@/lib/validation';
-import { generateImage, pollResult, ApiError, fetchMe } from '@/lib/api';
+import { generateImage, pollResult, ApiError, fetchMe, downloadResultsZip } from '@/lib/api';
 import { t } from '@/lib/i18n';
 import { useAuth } from '@/contexts/AuthContext';
 
@@ -31,6 +31,8 @@ export default function GeneratePage() {
   const [credits, setCredits] = useState<number | null>(null);
   const [creditsLoading, setCreditsLoading] = useState(false);
   const cancelRef = useRef({ cancelled: false });
+  // 同じ画像・指示の再送信（通信エラー後の再クリックなど）では同じキーを使い、二重課金を防ぐ
+  const idempotencyKeyRef = useRef<string | null>(null);
 
   const tips = useMemo(
     () => [
@@ -57,6 +59,10 @@ export default function GeneratePage() {
     }
   }, [idToken]);
 
+  useEffect(() => {
+    idempotencyKeyRef.current = null;
+  }, [preview, prompt]);
+
   useEffect(() => {
     if (idToken) {
       void refreshCredits();
@@ -121,7 +127,11 @@ export default function GeneratePage() {
             return;
           }
 
-          const delay = Math.min(2000, 1000 * Math.pow(1.5, attempt));
+          // サーバーが完了時間の分布から推定した待ち時間があればそれに従う
+          const delay =
+            typeof response.retry_after_ms === 'number'
+              ? Math.max(500, response.retry_after_ms)
+              : Math.min(2000, 1000 * Math.pow(1.5, attempt));
           attempt += 1;
           await wait(delay);
         }
@@ -155,14 +165,19 @@ export default function GeneratePage() {
 
     try {
       const base64 = await fileToBase64(preview.file);
+      if (!idempotencyKeyRef.current) {
+        idempotencyKeyRef.current = crypto.randomUUID();
+      }
       const response = await generateImage(
         {
           prompt,
           filename: preview.file.name,
           imageBase64: base64
         },
-        idToken
+        idToken,
+        idempotencyKeyRef.current
       );
+      idempotencyKeyRef.current = null;
 
       setCredits((prev) => (typeof prev === 'number' ? Math.max(prev - 1, 0) : prev));
       setStatus('processing');
@@ -172,6 +187,8 @@ export default function GeneratePage() {
       console.error(error);
       if (error instanceof ApiError && error.status === 402) {
         setErrorMessage('クレジットが不足しています。購入ページからチャージしてください。');
+      } else if (error instanceof ApiError && error.status === 503) {
+        setErrorMessage('ただいまアクセスが集中しています。数秒おいて再度お試しください。');
       } else {
         setErrorMessage('編集リクエストの送信に失敗しました。時間をおいて再度お試しください。');
       }
@@ -180,6 +197,22 @@ export default function GeneratePage() {
     }
   }, [idToken, pollForResult, preview, prompt, refreshCredits]);
 
+  const handleDownloadAll = useCallback(async () => {
+    if (!idToken) return;
+    try {
+      const blob = await downloadResultsZip(idToken);
+      const url = URL.createObjectURL(blob);
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = 'eternalai-results.zip';
+      link.click();
+      URL.revokeObjectURL(url);
+    } catch (error) {
+      console.error(error);
+      setErrorMessage('ZIPのダウンロードに失敗しました。時間をおいて再度お試しください。');
+    }
+  }, [idToken]);
+
   const cancelProcessing = useCallback(() => {
     cancelRef.current.cancelled = true;
     setStatus('ready');
@@ -299,7 +332,12 @@ export default function GeneratePage() {
             </div>
             <div className="flex flex-col gap-4 rounded-3xl border border-slate-800 bg-slate-900/70 p-6 shadow-xl">
               <h2 className="text-xl font-semibold text-white">生成結果</h2>
-              <ResultActions imageUrl={resultUrl} onReedit={handleReedit} onReset={resetAll} />
+              <ResultActions
+                imageUrl={resultUrl}
+                onReedit={handleReedit}
+                onReset={resetAll}
+                onDownloadAll={handleDownloadAll}
+              />
             </div>
           </section>
         )}
@@ -1,4 +1,4 @@
-import { useCallback, useState } from 'react';
+import { useCallback, useEffect, useRef, useState } from 'react';
 import Head from 'next/head';
 
 import { useAuth } from '@/contexts/AuthContext';
@@ -15,6 +15,12 @@ export default function PurchasePage() {
   const [selected, setSelected] = useState(CREDIT_PACKS[0].priceId);
   const [purchasing, setPurchasing] = useState(false);
   const [errorMessage, setErrorMessage] = useState<string | null>(null);
+  // 再試行では同じキーを送り、Checkout セッションを重複作成しない
+  const idempotencyKeyRef = useRef<string | null>(null);
+
+  useEffect(() => {
+    idempotencyKeyRef.current = null;
+  }, [selected]);
 
   const handleCheckout = useCallback(async () => {
     if (!idToken) {
@@ -24,7 +30,10 @@ export default function PurchasePage() {
     try {
       setPurchasing(true);
       setErrorMessage(null);
-      const response = await createCheckoutSession(selected, 1, idToken);
+      if (!idempotencyKeyRef.current) {
+        idempotencyKeyRef.current = crypto.randomUUID();
+      }
+      const response = await createCheckoutSession(selected, 1, idToken, idempotencyKeyRef.current);
       window.location.href = response.url;
     } catch (error) {
       console.error(error);
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+
+ADMISSION_MAX_LOOP_LAG_MS = float(os.getenv("ADMISSION_MAX_LOOP_LAG_MS", "250"))
+ADMISSION_MAX_INFLIGHT_UPSTREAM = int(os.getenv("ADMISSION_MAX_INFLIGHT_UPSTREAM", "32"))
+ADMISSION_MAX_INFLIGHT_BODY_BYTES = int(
+    os.getenv("ADMISSION_MAX_INFLIGHT_BODY_BYTES", str(256 * 1024 * 1024))
+)
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "5"))
+LOOP_LAG_SAMPLE_INTERVAL = 0.1
+
+# 重い（課金・外部API呼び出しを伴う）エンドポイントだけを制限対象にする
+SHED_PATHS = frozenset({"/api/generate", "/api/edit"})
+
+
+class AdmissionState:
+    def __init__(self) -> None:
+        self.loop_lag = 0.0
+        self._last_tick: float | None = None
+        self.inflight_upstream = 0
+        self.inflight_body_bytes = 0
+
+    def current_lag(self) -> float:
+        """Lag of the last sample, or how overdue the next sample already is."""
+
+        if self._last_tick is None:
+            return self.loop_lag
+        overdue = time.monotonic() - self._last_tick - LOOP_LAG_SAMPLE_INTERVAL
+        return max(self.loop_lag, overdue)
+
+    async def monitor_loop_lag(self) -> None:
+        while True:
+            self._last_tick = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_SAMPLE_INTERVAL)
+            self.loop_lag = max(0.0, time.monotonic() - self._last_tick - LOOP_LAG_SAMPLE_INTERVAL)
+
+    def rejection_reason(self, body_bytes: int) -> str | None:
+        if self.current_lag() * 1000 > ADMISSION_MAX_LOOP_LAG_MS:
+            return "event loop lag"
+        if self.inflight_upstream >= ADMISSION_MAX_INFLIGHT_UPSTREAM:
+            return "too many upstream calls"
+        if self.inflight_body_bytes and self.inflight_body_bytes + body_bytes > ADMISSION_MAX_INFLIGHT_BODY_BYTES:
+            return "too many request bytes in flight"
+        return None
+
+    @asynccontextmanager
+    async def upstream_call(self) -> AsyncIterator[None]:
+        self.inflight_upstream += 1
+        try:
+            yield
+        finally:
+            self.inflight_upstream -= 1
+
+
+admission_state = AdmissionState()
+
+
+class AdmissionControlMiddleware(BaseHTTPMiddleware):
+    """Reject new generation work with 503 + Retry-After while the worker is overloaded.
+
+    Runs before the body is read and before any credits are debited; other endpoints
+    (poll, me, history, ...) are always admitted.
+    """
+
+    async def dispatch(self, request: Request, call_next):
+        if request.method != "POST" or request.url.path not in SHED_PATHS:
+            return await call_next(request)
+
+        try:
+            body_bytes = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            body_bytes = 0
+
+        reason = admission_state.rejection_reason(body_bytes)
+        if reason:
+            return JSONResponse(
+                {"detail": f"Server is busy ({reason}), please retry later"},
+                status_code=503,
+                headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)},
+            )
+
+        admission_state.inflight_body_bytes += body_bytes
+        try:
+            return await call_next(request)
+        finally:
+            admission_state.inflight_body_bytes -= body_bytes
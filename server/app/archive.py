@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import Table, delete, insert, select
+
+from .database import db_session
+from .db_models import Charge, ChargeArchive, Consumption, ConsumptionArchive
+from .rollups import bump_ledger_version
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+
+# ホットテーブル -> アーカイブテーブル
+ARCHIVE_TABLES: Dict[str, tuple[Table, Table]] = {
+    "charges": (Charge.__table__, ChargeArchive.__table__),
+    "consumptions": (Consumption.__table__, ConsumptionArchive.__table__),
+}
+
+
+def _archive_batch(hot: Table, cold: Table, cutoff: datetime, batch_size: int) -> int:
+    """Move one batch of rows older than ``cutoff``; each batch is its own transaction."""
+
+    with db_session() as db:
+        rows = db.execute(
+            select(hot.c.id, hot.c.uid)
+            .where(hot.c.created_at < cutoff)
+            .order_by(hot.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return 0
+
+        ids = [row.id for row in rows]
+        columns = [column.name for column in cold.c]
+        db.execute(
+            insert(cold).from_select(
+                columns,
+                select(*(hot.c[name] for name in columns)).where(hot.c.id.in_(ids)),
+            )
+        )
+        db.execute(delete(hot).where(hot.c.id.in_(ids)))
+        # ホット側の履歴が変わるので ETag を更新する
+        for uid in {row.uid for row in rows}:
+            bump_ledger_version(db, uid)
+        return len(ids)
+
+
+def archive_old_rows(
+    older_than_days: int = ARCHIVE_AFTER_DAYS,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+) -> Dict[str, int]:
+    """Move ledger rows older than ``older_than_days`` into the archive tables."""
+
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    moved: Dict[str, int] = {}
+    for name, (hot, cold) in ARCHIVE_TABLES.items():
+        total = 0
+        while True:
+            count = _archive_batch(hot, cold, cutoff, batch_size)
+            total += count
+            if count < batch_size:
+                break
+        moved[name] = total
+    if any(moved.values()):
+        logger.info("Archived ledger rows", extra={"archived": moved})
+    return moved
+
+
+async def run_archive_loop(interval_seconds: int) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(archive_old_rows)
+        except Exception:  # noqa: BLE001
+            logger.exception("Ledger archival failed")
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Move old charges/consumptions into the archive tables.")
+    parser.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args(argv)
+    print(archive_old_rows(args.older_than_days, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,8 +11,9 @@ from firebase_admin import auth as firebase_auth, credentials
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
-from .database import get_db
+from .database import db_session, get_db, get_read_db
 from .db_models import User
+from .rollups import bump_ledger_version
 
 
 http_bearer = HTTPBearer(auto_error=True)
@@ -61,10 +62,7 @@ def verify_id_token(id_token: str) -> dict:
         ) from exc
 
 
-def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(http_bearer),
-    db: Session = Depends(get_db),
-) -> User:
+def _decode_credentials(credentials: HTTPAuthorizationCredentials) -> tuple[str, Optional[str]]:
     token = credentials.credentials
     decoded = verify_id_token(token)
     uid = decoded.get("uid")
@@ -72,7 +70,10 @@ def get_current_user(
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
     email: Optional[str] = decoded.get("email")
+    return uid, email
+
 
+def _get_or_create_user(db: Session, uid: str, email: Optional[str]) -> User:
     stmt = select(User).where(User.uid == uid)
     user = db.execute(stmt).scalar_one_or_none()
     if user is None:
@@ -84,7 +85,47 @@ def get_current_user(
         if email and user.email != email:
             user.email = email
             db.add(user)
+            bump_ledger_version(db, uid)
             db.commit()
             db.refresh(user)
 
     return user
+
+
+def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(http_bearer),
+    db: Session = Depends(get_db),
+) -> User:
+    uid, email = _decode_credentials(credentials)
+    return _get_or_create_user(db, uid, email)
+
+
+def get_current_user_readonly(
+    credentials: HTTPAuthorizationCredentials = Depends(http_bearer),
+    read_db: Session = Depends(get_read_db),
+) -> User:
+    """Like get_current_user, but looks the user up on the read replica.
+
+    Only falls back to the primary when the user has to be created or updated.
+    """
+
+    uid, email = _decode_credentials(credentials)
+    user = read_db.execute(select(User).where(User.uid == uid)).scalar_one_or_none()
+    if user is not None and not (email and user.email != email):
+        return user
+
+    with db_session() as db:
+        user = _get_or_create_user(db, uid, email)
+        db.expunge(user)
+    return user
+
+
+def _admin_uids() -> set[str]:
+    raw = os.getenv("ADMIN_UIDS", "")
+    return {uid.strip() for uid in raw.split(",") if uid.strip()}
+
+
+def get_admin_user(current_user: User = Depends(get_current_user_readonly)) -> User:
+    if current_user.uid not in _admin_uids():
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
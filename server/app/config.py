@@ -8,6 +8,10 @@ class Settings(BaseSettings):
   eternal_ai_api_url: str = Field(default='https://agentic.eternalai.org/uncensored-image')
   eternal_ai_result_url: str = Field(default='https://agentic.eternalai.org/result/uncensored-image')
   request_timeout: int = 60
+  # live | record | replay — record/replay は性能回帰テスト用
+  eternal_ai_mode: str = Field(default='live', env='ETERNAL_AI_MODE')
+  eternal_ai_recording_path: str = Field(default='eternalai_recording.jsonl', env='ETERNAL_AI_RECORDING_PATH')
+  eternal_ai_replay_speed: float = Field(default=1.0, env='ETERNAL_AI_REPLAY_SPEED')
 
   class Config:
     env_file = '.env'
@@ -4,7 +4,8 @@ import os
 from contextlib import contextmanager
 from typing import Generator
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 
 
@@ -19,14 +20,52 @@ def _normalize_database_url(url: str) -> str:
 DATABASE_URL = _normalize_database_url(
     os.getenv("DATABASE_URL", "sqlite:///./app.db")
 )
+READ_DATABASE_URL = _normalize_database_url(os.getenv("READ_DATABASE_URL", "").strip())
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    future=True,
-)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+
+def _pool_options(url: str) -> dict:
+    """Env-driven pool settings; SQLite keeps SQLAlchemy's own pool choice."""
+
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    }
+
+
+def _create_engine(url: str) -> Engine:
+    created = create_engine(
+        url,
+        pool_pre_ping=True,
+        future=True,
+        **_pool_options(url),
+    )
+    if created.dialect.name == "sqlite":
+        event.listen(created, "connect", _apply_sqlite_pragmas)
+    return created
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    finally:
+        cursor.close()
+
+
+engine = _create_engine(DATABASE_URL)
+# 参照系クエリ用のレプリカ（未設定ならプライマリをそのまま使う）
+read_engine = _create_engine(READ_DATABASE_URL) if READ_DATABASE_URL else engine
 
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+ReadSessionLocal = sessionmaker(bind=read_engine, autoflush=False, autocommit=False, future=True)
 
 
 def get_db() -> Generator:
@@ -37,6 +76,16 @@ def get_db() -> Generator:
         db.close()
 
 
+def get_read_db() -> Generator:
+    """Session for read-only queries; routed to READ_DATABASE_URL when configured."""
+
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
 @contextmanager
 def db_session() -> Generator:
     db = SessionLocal()
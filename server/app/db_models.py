@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy import Boolean, Column, Date, DateTime, ForeignKey, Integer, String, Text
 from sqlalchemy.orm import DeclarativeBase, relationship
 
 
@@ -44,6 +44,9 @@ class Charge(Base):
 
 class Consumption(Base):
     __tablename__ = "consumptions"
+    # アーカイブ済みの id を SQLite が再利用しないように AUTOINCREMENT にする
+    # （consumptions_archive は元の id を主キーとしてそのまま保持する）
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     uid = Column(String, ForeignKey("users.uid"), nullable=False)
@@ -54,3 +57,74 @@ class Consumption(Base):
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
 
     user = relationship("User", back_populates="consumptions")
+
+
+class ChargeArchive(Base):
+    __tablename__ = "charges_archive"
+
+    id = Column(String, primary_key=True)
+    uid = Column(String, nullable=False, index=True)
+    price_id = Column(String, nullable=True)
+    quantity = Column(Integer, nullable=False, default=1)
+    credits_added = Column(Integer, nullable=False)
+    amount_total_jpy = Column(Integer, nullable=False)
+    currency = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+
+class ConsumptionArchive(Base):
+    __tablename__ = "consumptions_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    uid = Column(String, nullable=False, index=True)
+    credits_used = Column(Integer, nullable=False)
+    reason = Column(Text, nullable=True)
+    request_id = Column(String, nullable=True)
+    refunded = Column(Boolean, nullable=False, default=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+
+class DailyUserUsage(Base):
+    __tablename__ = "daily_user_usage"
+
+    uid = Column(String, ForeignKey("users.uid"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    credits_purchased = Column(Integer, nullable=False, default=0)
+    amount_total_jpy = Column(Integer, nullable=False, default=0)
+    charge_count = Column(Integer, nullable=False, default=0)
+    credits_consumed = Column(Integer, nullable=False, default=0)
+    generation_count = Column(Integer, nullable=False, default=0)
+    credits_refunded = Column(Integer, nullable=False, default=0)
+    refund_count = Column(Integer, nullable=False, default=0)
+
+
+class DailyUsage(Base):
+    __tablename__ = "daily_usage"
+
+    day = Column(Date, primary_key=True)
+    credits_purchased = Column(Integer, nullable=False, default=0)
+    amount_total_jpy = Column(Integer, nullable=False, default=0)
+    charge_count = Column(Integer, nullable=False, default=0)
+    credits_consumed = Column(Integer, nullable=False, default=0)
+    generation_count = Column(Integer, nullable=False, default=0)
+    credits_refunded = Column(Integer, nullable=False, default=0)
+    refund_count = Column(Integer, nullable=False, default=0)
+
+
+class LedgerVersion(Base):
+    __tablename__ = "ledger_versions"
+
+    uid = Column(String, ForeignKey("users.uid"), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    uid = Column(String, ForeignKey("users.uid"), primary_key=True)
+    scope = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import logging
+import mimetypes
+import os
+import zipfile
+from typing import AsyncIterator, List, Optional, Tuple
+from urllib.parse import unquote_to_bytes
+
+import httpx
+
+from .config import get_settings
+from .models import Job
+
+
+logger = logging.getLogger(__name__)
+
+ZIP_FETCH_CONCURRENCY = int(os.getenv("ZIP_FETCH_CONCURRENCY", "4"))
+ZIP_MAX_JOBS = int(os.getenv("ZIP_MAX_JOBS", "100"))
+_ENTRY_CHUNK_BYTES = 64 * 1024
+
+
+class _ZipSink:
+  """Write-only, unseekable target for ZipFile; collected bytes are drained after each entry."""
+
+  def __init__(self) -> None:
+    self._chunks: List[bytes] = []
+
+  def write(self, data: bytes) -> int:
+    self._chunks.append(bytes(data))
+    return len(data)
+
+  def flush(self) -> None:
+    pass
+
+  def drain(self) -> bytes:
+    data = b''.join(self._chunks)
+    self._chunks.clear()
+    return data
+
+
+def _decode_data_url(url: str) -> Tuple[bytes, str]:
+  header, _, payload = url[len('data:'):].partition(',')
+  content_type = header.split(';')[0] or 'application/octet-stream'
+  if header.endswith(';base64'):
+    return base64.b64decode(payload), content_type
+  return unquote_to_bytes(payload), content_type
+
+
+async def _fetch_result(client: httpx.AsyncClient, url: str) -> Tuple[bytes, str]:
+  if url.startswith('data:'):
+    return _decode_data_url(url)
+  response = await client.get(url)
+  response.raise_for_status()
+  content_type = response.headers.get('content-type', 'application/octet-stream').split(';')[0]
+  return response.content, content_type
+
+
+def _entry_name(index: int, job: Job, content_type: str) -> str:
+  extension = mimetypes.guess_extension(content_type) or '.bin'
+  if extension == '.jpe':
+    extension = '.jpg'
+  return f'{index:03d}_{job.request_id or job.id}{extension}'
+
+
+async def stream_results_zip(jobs: List[Job]) -> AsyncIterator[bytes]:
+  """Yield a ZIP of the jobs' results, written entry by entry.
+
+  ``ZIP_FETCH_CONCURRENCY`` workers take the next job only after their previous
+  result is queued, so at most twice that many results are held in memory no
+  matter how many jobs there are, however slowly the client reads.
+  """
+
+  queue: asyncio.Queue[Tuple[int, Job, Optional[bytes], str]] = asyncio.Queue(
+    maxsize=ZIP_FETCH_CONCURRENCY
+  )
+  pending = iter(enumerate(jobs, start=1))
+  settings = get_settings()
+
+  async with httpx.AsyncClient(timeout=settings.request_timeout, follow_redirects=True) as client:
+
+    async def worker() -> None:
+      for index, job in pending:
+        try:
+          data, content_type = await _fetch_result(client, job.result_url or '')
+        except Exception as exc:  # noqa: BLE001
+          logger.warning("Failed to fetch result for %s: %s", job.request_id, exc)
+          data, content_type = None, str(exc)
+        await queue.put((index, job, data, content_type))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(ZIP_FETCH_CONCURRENCY, len(jobs)))]
+    sink = _ZipSink()
+    missing: List[str] = []
+    try:
+      # 画像は圧縮済みなので無圧縮で格納する
+      with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        # 終了の目印は使わず件数で数える（中断時にワーカーが目印の投入で詰まらないように）
+        for _ in range(len(jobs)):
+          index, job, data, content_type = await queue.get()
+          if data is None:
+            missing.append(f'{job.request_id or job.id}: {content_type}')
+            continue
+          with archive.open(_entry_name(index, job, content_type), 'w', force_zip64=True) as entry:
+            view = memoryview(data)
+            for start in range(0, len(view), _ENTRY_CHUNK_BYTES):
+              entry.write(view[start:start + _ENTRY_CHUNK_BYTES])
+              chunk = sink.drain()
+              if chunk:
+                yield chunk
+          yield sink.drain()
+        if missing:
+          archive.writestr('missing.txt', '\n'.join(missing) + '\n')
+      yield sink.drain()
+    finally:
+      for task in workers:
+        task.cancel()
+      await asyncio.gather(*workers, return_exceptions=True)
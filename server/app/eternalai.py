@@ -2,62 +2,91 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import json
+import logging
 import os
 import random
-from typing import Optional
+import re
+from typing import AsyncIterator, Optional
 
 import httpx
 
 from .config import get_settings
 from .models import Job
+from .upstream_recording import upstream_transport
+
+
+logger = logging.getLogger(__name__)
+
+# base64 の画像を丸ごとコピーしないよう、JSON の外枠だけを組み立てて画像部分はスライスで流す
+_PAYLOAD_CHUNK_CHARS = 64 * 1024
+_BASE64_RE = re.compile(r'[A-Za-z0-9+/=_-]*')
+
+
+def _encode_edit_payload(job: Job, image_base64: str) -> tuple[Optional[int], AsyncIterator[bytes]]:
+  """Return (content length, body iterator) for the EternalAI edit request.
+
+  The body is byte-for-byte the JSON that ``json=payload`` used to produce, but the
+  image is streamed in slices instead of being copied into a data URL and then into
+  httpx's serialization buffer. The length is ``None`` when the image needs JSON
+  escaping, in which case the body is sent chunked.
+  """
+  head = (
+    '{"messages": [{"role": "user", "content": [{"type": "image_url", '
+    '"image_url": {"url": "data:image/jpeg;base64,'
+  ).encode('ascii')
+  tail = (
+    f'", "filename": {json.dumps(job.original_filename)}}}}}, '
+    f'{{"type": "text", "text": {json.dumps(job.prompt)}}}]}}], "type": "edit"}}'
+  ).encode('ascii')
+  plain = _BASE64_RE.fullmatch(image_base64) is not None
+
+  async def body() -> AsyncIterator[bytes]:
+    yield head
+    for start in range(0, len(image_base64), _PAYLOAD_CHUNK_CHARS):
+      chunk = image_base64[start:start + _PAYLOAD_CHUNK_CHARS]
+      if plain:
+        yield chunk.encode('ascii')
+      else:
+        yield json.dumps(chunk)[1:-1].encode('ascii')
+    yield tail
+
+  content_length = len(head) + len(image_base64) + len(tail) if plain else None
+  return content_length, body()
 
 
 async def send_edit_request(job: Job, image_base64: str) -> Optional[str]:
   settings = get_settings()
   api_key = settings.eternal_ai_api_key
+  if settings.eternal_ai_mode == 'replay':
+    # 再生モードでは録画したレスポンスを返すのでキーは使われない
+    api_key = api_key or 'replay'
   if not api_key:
     return await _simulate_request(job)
 
-  payload = {
-    'messages': [
-      {
-        'role': 'user',
-        'content': [
-          {
-            'type': 'image_url',
-            'image_url': {
-              'url': f"data:image/jpeg;base64,{image_base64}",
-              'filename': job.original_filename
-            }
-          },
-          {
-            'type': 'text',
-            'text': job.prompt
-          }
-        ]
-      }
-    ],
-    'type': 'edit'
-  }
-
+  content_length, body = _encode_edit_payload(job, image_base64)
   headers = {
     'x-api-key': api_key,
     'Content-Type': 'application/json'
   }
+  if content_length is not None:
+    headers['Content-Length'] = str(content_length)
 
   _is_production = os.getenv("ENVIRONMENT", "").lower() in ("production", "prod")
+  # 録画・再生中にシミュレーションへ落ちると計測結果が混ざるので、その場合もエラーを返す
+  _can_simulate = not _is_production and settings.eternal_ai_mode == 'live'
   
   try:
-    async with httpx.AsyncClient(timeout=settings.request_timeout) as client:
-      response = await client.post(settings.eternal_ai_api_url, json=payload, headers=headers)
+    async with httpx.AsyncClient(timeout=settings.request_timeout, transport=upstream_transport(settings)) as client:
+      response = await client.post(settings.eternal_ai_api_url, content=body, headers=headers)
       response.raise_for_status()
       data = response.json()
       return data.get('request_id')
   except httpx.HTTPStatusError as e:
     status_code = e.response.status_code
     # 開発環境では401や500エラーもシミュレーションモードにフォールバック
-    if status_code in (401, 500) and not _is_production:
-      print(f"Warning: External API request returned {status_code}, falling back to simulation mode")
+    if status_code in (401, 500) and _can_simulate:
+      logger.warning("External API request returned %s, falling back to simulation mode", status_code)
       return await _simulate_request(job)
     # 本番環境では401エラーをより分かりやすく
     if status_code == 401 and _is_production:
@@ -66,34 +95,39 @@ async def send_edit_request(job: Job, image_base64: str) -> Optional[str]:
     raise
   except Exception as e:
     # ネットワークエラーなど
-    if _is_production:
+    if not _can_simulate:
       # 本番環境ではエラーをそのまま投げる
       raise
     # ローカル開発用にシミュレーションモードにフォールバック
-    print(f"Warning: External API request failed ({type(e).__name__}: {e}), falling back to simulation mode")
+    logger.warning("External API request failed (%s: %s), falling back to simulation mode", type(e).__name__, e)
     return await _simulate_request(job)
 
 
 async def poll_result(request_id: str) -> dict:
   settings = get_settings()
   api_key = settings.eternal_ai_api_key
+  if settings.eternal_ai_mode == 'replay':
+    # 再生モードでは録画したレスポンスを返すのでキーは使われない
+    api_key = api_key or 'replay'
   if not api_key:
     return await _simulate_poll(request_id)
 
   _is_production = os.getenv("ENVIRONMENT", "").lower() in ("production", "prod")
+  # 録画・再生中にシミュレーションへ落ちると計測結果が混ざるので、その場合もエラーを返す
+  _can_simulate = not _is_production and settings.eternal_ai_mode == 'live'
   
   headers = {'x-api-key': api_key}
   params = {'request_id': request_id}
   try:
-    async with httpx.AsyncClient(timeout=settings.request_timeout) as client:
+    async with httpx.AsyncClient(timeout=settings.request_timeout, transport=upstream_transport(settings)) as client:
       response = await client.get(settings.eternal_ai_result_url, params=params, headers=headers)
       response.raise_for_status()
       return response.json()
   except httpx.HTTPStatusError as e:
     status_code = e.response.status_code
     # 開発環境では401や500エラーもシミュレーションモードにフォールバック
-    if status_code in (401, 500) and not _is_production:
-      print(f"Warning: External API poll returned {status_code}, falling back to simulation mode")
+    if status_code in (401, 500) and _can_simulate:
+      logger.warning("External API poll returned %s, falling back to simulation mode", status_code)
       return await _simulate_poll(request_id)
     # 本番環境では401エラーをより分かりやすく
     if status_code == 401 and _is_production:
@@ -102,11 +136,11 @@ async def poll_result(request_id: str) -> dict:
     raise
   except Exception as e:
     # ネットワークエラーなど
-    if _is_production:
+    if not _can_simulate:
       # 本番環境ではエラーをそのまま投げる
       raise
     # ローカル開発用にシミュレーションモードにフォールバック
-    print(f"Warning: External API poll failed ({type(e).__name__}: {e}), falling back to simulation mode")
+    logger.warning("External API poll failed (%s: %s), falling back to simulation mode", type(e).__name__, e)
     return await _simulate_poll(request_id)
 
 
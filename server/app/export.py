@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime
+from typing import Iterator, Optional
+
+from sqlalchemy import Table, select
+
+from .database import ReadSessionLocal
+from .db_models import Charge, ChargeArchive, Consumption, ConsumptionArchive
+
+
+EXPORT_TABLES = {
+    "charges": Charge.__table__,
+    "consumptions": Consumption.__table__,
+}
+ARCHIVE_EXPORT_TABLES = {
+    "charges": ChargeArchive.__table__,
+    "consumptions": ConsumptionArchive.__table__,
+}
+EXPORT_FORMATS = ("ndjson", "csv")
+EXPORT_BATCH_SIZE = 1000
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _export_statement(
+    table: Table,
+    columns: list[str],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    uid: Optional[str] = None,
+):
+    stmt = select(*(table.c[name] for name in columns)).order_by(table.c.created_at, table.c.id)
+    if start is not None:
+        stmt = stmt.where(table.c.created_at >= start)
+    if end is not None:
+        stmt = stmt.where(table.c.created_at < end)
+    if uid:
+        stmt = stmt.where(table.c.uid == uid)
+    return stmt.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE)
+
+
+def iter_export(
+    table_name: str,
+    fmt: str = "ndjson",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    uid: Optional[str] = None,
+    include_archived: bool = False,
+) -> Iterator[str]:
+    """Yield ``table_name`` rows as NDJSON or CSV using a server-side cursor.
+
+    Each yielded chunk holds up to ``EXPORT_BATCH_SIZE`` lines, so a
+    ``StreamingResponse`` makes one threadpool hop per batch rather than per row.
+    With ``include_archived`` the (older) archived rows are streamed first. The
+    generator owns its session so it can outlive the request that started it.
+    """
+
+    table = EXPORT_TABLES[table_name]
+    tables = [ARCHIVE_EXPORT_TABLES[table_name], table] if include_archived else [table]
+    columns = [column.name for column in table.c]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def _csv_line(values) -> str:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    if fmt == "csv":
+        yield _csv_line(columns)
+
+    db = ReadSessionLocal()
+    try:
+        for source in tables:
+            result = db.execute(_export_statement(source, columns, start, end, uid))
+            for rows in result.partitions():
+                lines = []
+                for row in rows:
+                    values = [_encode_value(value) for value in row]
+                    if fmt == "csv":
+                        lines.append(_csv_line(values))
+                    else:
+                        lines.append(json.dumps(dict(zip(columns, values)), ensure_ascii=False) + "\n")
+                yield "".join(lines)
+    finally:
+        db.close()
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Stream ledger rows as NDJSON or CSV to stdout.")
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES))
+    parser.add_argument("--format", dest="fmt", choices=EXPORT_FORMATS, default="ndjson")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="inclusive, ISO 8601 (UTC)")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="exclusive, ISO 8601 (UTC)")
+    parser.add_argument("--uid")
+    parser.add_argument("--include-archived", action="store_true")
+    args = parser.parse_args(argv)
+
+    for line in iter_export(
+        args.table, args.fmt, args.start, args.end, args.uid, include_archived=args.include_archived
+    ):
+        sys.stdout.write(line)
+
+
+if __name__ == "__main__":
+    main()
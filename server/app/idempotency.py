@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .db_models import IdempotencyKey
+
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "90"))
+# 処理中のままワーカーが落ちたキーを引き継げるまでの時間
+IDEMPOTENCY_PENDING_TIMEOUT_SECONDS = int(os.getenv("IDEMPOTENCY_PENDING_TIMEOUT_SECONDS", "300"))
+_WAIT_INTERVAL_SECONDS = 0.25
+_MAX_KEY_LENGTH = 255
+_DIGEST_CHUNK_CHARS = 64 * 1024
+
+
+def fingerprint(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, default=str).encode("utf-8")).hexdigest()
+
+
+def digest_text(value: str) -> str:
+    """sha256 of ``value`` (e.g. a base64 image), encoded in slices rather than copied whole."""
+
+    digest = hashlib.sha256()
+    for start in range(0, len(value), _DIGEST_CHUNK_CHARS):
+        digest.update(value[start:start + _DIGEST_CHUNK_CHARS].encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _check(
+    db: Session, scope: str, uid: str, key: str, request_fingerprint: str
+) -> tuple[bool, Optional[dict]]:
+    """Claim ``key`` or inspect whoever holds it.
+
+    Returns ``(True, None)`` when this request now owns the key, ``(False, response)``
+    when a stored response can be replayed and ``(False, None)`` while the first
+    request is still running.
+    """
+
+    if len(key) > _MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+    now = datetime.utcnow()
+    row = db.get(IdempotencyKey, (uid, scope, key), populate_existing=True)
+    if row is not None and (
+        row.expires_at <= now
+        or (
+            row.response_body is None
+            and row.created_at <= now - timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT_SECONDS)
+        )
+    ):
+        db.delete(row)
+        db.commit()
+        row = None
+
+    if row is None:
+        db.add(
+            IdempotencyKey(
+                uid=uid,
+                scope=scope,
+                key=key,
+                fingerprint=request_fingerprint,
+                created_at=now,
+                expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+            )
+        )
+        try:
+            db.commit()
+            return True, None
+        except IntegrityError:
+            db.rollback()
+        row = db.get(IdempotencyKey, (uid, scope, key), populate_existing=True)
+        if row is None:
+            return False, None
+
+    if row.fingerprint != request_fingerprint:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used for a different request",
+        )
+    if row.response_body is None:
+        return False, None
+    return False, json.loads(row.response_body)
+
+
+def _in_progress() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="A request with this Idempotency-Key is still in progress",
+    )
+
+
+async def begin(
+    db: Session, scope: str, uid: str, key: str, request_fingerprint: str
+) -> Optional[dict]:
+    """Return the stored response for a replay, or ``None`` once this request owns ``key``.
+
+    Concurrent duplicates wait here until the first request completes or releases the key.
+    """
+
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        claimed, stored = _check(db, scope, uid, key, request_fingerprint)
+        if claimed:
+            return None
+        if stored is not None:
+            return stored
+        if time.monotonic() >= deadline:
+            raise _in_progress()
+        await asyncio.sleep(_WAIT_INTERVAL_SECONDS)
+
+
+def begin_sync(
+    db: Session, scope: str, uid: str, key: str, request_fingerprint: str
+) -> Optional[dict]:
+    """Blocking variant of :func:`begin` for endpoints that run in the threadpool."""
+
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        claimed, stored = _check(db, scope, uid, key, request_fingerprint)
+        if claimed:
+            return None
+        if stored is not None:
+            return stored
+        if time.monotonic() >= deadline:
+            raise _in_progress()
+        time.sleep(_WAIT_INTERVAL_SECONDS)
+
+
+def complete(db: Session, scope: str, uid: str, key: str, response: dict) -> None:
+    row = db.get(IdempotencyKey, (uid, scope, key))
+    if row is None:
+        return
+    row.response_body = json.dumps(response)
+    db.add(row)
+    db.commit()
+
+
+def release(db: Session, scope: str, uid: str, key: str) -> None:
+    """Drop a pending key after a failure so the client can retry with it."""
+
+    db.rollback()
+    db.execute(
+        delete(IdempotencyKey).where(
+            IdempotencyKey.uid == uid,
+            IdempotencyKey.scope == scope,
+            IdempotencyKey.key == key,
+            IdempotencyKey.response_body.is_(None),
+        )
+    )
+    db.commit()
+
+
+def purge_expired(db: Session) -> int:
+    result = db.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow()))
+    return result.rowcount or 0
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+from uuid import uuid4
+
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_ERROR_BURST = int(os.getenv("LOG_ERROR_BURST", "10"))
+LOG_ERROR_WINDOW_SECONDS = float(os.getenv("LOG_ERROR_WINDOW_SECONDS", "60"))
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+_RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; runs on the listener thread, including traceback formatting."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ErrorRateLimitFilter(logging.Filter):
+    """Let at most ``burst`` identical errors through per window; report how many were dropped.
+
+    Identical means same logger, message template and exception type, so an upstream
+    outage logs a handful of tracebacks instead of one per failed request.
+    """
+
+    def __init__(self, burst: int = LOG_ERROR_BURST, window: float = LOG_ERROR_WINDOW_SECONDS) -> None:
+        super().__init__()
+        self._burst = burst
+        self._window = window
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.ERROR or self._burst <= 0:
+            return True
+
+        exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        key = (record.name, record.msg, exc_type)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or now - bucket[0] >= self._window:
+                suppressed = bucket[2] if bucket else 0
+                self._buckets[key] = [now, 1, 0]
+                if len(self._buckets) > 1000:
+                    self._buckets = {k: v for k, v in self._buckets.items() if now - v[0] < self._window}
+            elif bucket[1] < self._burst:
+                bucket[1] += 1
+                suppressed = 0
+            else:
+                bucket[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id = request_id_var.get()
+        if request_id and not hasattr(record, "request_id"):
+            record.request_id = request_id
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them and never blocks.
+
+    Records that do not fit in the queue are counted, and the count is logged as
+    a warning ahead of the next record that does fit.
+    """
+
+    dropped = 0
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self._unreported = 0
+        self._drop_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # メッセージだけ確定させ、トレースバックの整形はリスナースレッドに任せる
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def _drop(self, carried: int = 0) -> None:
+        # carried: 報告できなかった前回までの件数を戻す
+        with self._drop_lock:
+            self._unreported += carried + 1
+            NonBlockingQueueHandler.dropped += 1
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        with self._drop_lock:
+            unreported, self._unreported = self._unreported, 0
+        if unreported:
+            notice = logging.makeLogRecord({
+                "name": __name__,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"Dropped {unreported} log records because the log queue was full",
+                "dropped": unreported,
+            })
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                self._drop(unreported)
+                return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._drop()
+
+
+_listener: Optional[QueueListener] = None
+
+
+def configure_logging() -> None:
+    """Route the root logger through a bounded queue to a JSON stdout handler."""
+
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter())
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(ErrorRateLimitFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx は外部API呼び出しごとに INFO を出すので抑える
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """Drain the queue; called on shutdown."""
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestIdMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        request_id = request.headers.get(REQUEST_ID_HEADER) or uuid4().hex
+        token = request_id_var.set(request_id[:64])
+        try:
+            response = await call_next(request)
+        finally:
+            request_id_var.reset(token)
+        response.headers[REQUEST_ID_HEADER] = request_id[:64]
+        return response
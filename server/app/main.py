@@ -1,21 +1,38 @@
 from __future__ import annotations
+import asyncio
+import hashlib
+import logging
+import math
 import os
-import traceback
+from datetime import datetime, timedelta
 from typing import List
 
 import stripe
-from fastapi import Depends, FastAPI, HTTPException, Query, Request, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
-from sqlalchemy import select
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
 
+from . import idempotency
+from .logs import REQUEST_ID_HEADER, RequestIdMiddleware, configure_logging, stop_logging
+from .admission import AdmissionControlMiddleware, admission_state
 from .config import get_settings
-from .database import engine, get_db
-from .db_models import Base, Charge, Consumption, User
-from .auth import get_current_user
+from .database import db_session, engine, get_db, get_read_db
+from .db_models import (
+    Base,
+    Charge,
+    ChargeArchive,
+    Consumption,
+    ConsumptionArchive,
+    DailyUsage,
+    DailyUserUsage,
+    User,
+)
+from .auth import get_admin_user, get_current_user, get_current_user_readonly
 from .models import (
+    AdminStatsResponse,
     CheckoutSessionRequest,
     CheckoutSessionResponse,
     EditRequest,
@@ -24,11 +41,28 @@ from .models import (
     MeResponse,
     PollResponse,
     JobStatus,
+    SummaryResponse,
 )
 from .store import job_store
 from .eternalai import send_edit_request, poll_result
+from .archive import run_archive_loop
+from .downloads import ZIP_MAX_JOBS, stream_results_zip
+from .export import EXPORT_FORMATS, EXPORT_TABLES, iter_export
+from .poll_hints import completion_times
+from .rollups import (
+    USAGE_FIELDS,
+    bump_ledger_version,
+    get_ledger_version,
+    record_charge,
+    record_consumption,
+    run_reconciliation_loop,
+    usage_totals,
+)
 
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
 Base.metadata.create_all(bind=engine)
 
 app = FastAPI(title="EternalAI Image Editor API", version="1.0.0")
@@ -44,11 +78,63 @@ PRICE_TO_CREDITS = {
 }
 
 DEFAULT_GENERATION_COST = int(os.getenv("GENERATION_CREDITS_COST", "1"))
+# 有効にするとクレジットの確保と EternalAI へのアップロードを並行して行う
+GENERATION_PIPELINED = os.getenv("GENERATION_PIPELINED", "false").lower() in ("1", "true", "yes")
 
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 SUCCESS_URL = os.getenv("STRIPE_SUCCESS_URL", f"{FRONTEND_URL}/success")
 CANCEL_URL = os.getenv("STRIPE_CANCEL_URL", f"{FRONTEND_URL}/cancel")
 
+ROLLUP_RECONCILE_INTERVAL_SECONDS = int(os.getenv("ROLLUP_RECONCILE_INTERVAL_SECONDS", "3600"))
+ROLLUP_RECONCILE_LOOKBACK_DAYS = int(os.getenv("ROLLUP_RECONCILE_LOOKBACK_DAYS", "2"))
+
+JOB_DEADLINE_SECONDS = int(os.getenv("JOB_DEADLINE_SECONDS", "600"))
+JOB_REAPER_INTERVAL_SECONDS = int(os.getenv("JOB_REAPER_INTERVAL_SECONDS", "60"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+JOB_REAPER_CONCURRENCY = int(os.getenv("JOB_REAPER_CONCURRENCY", "8"))
+
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = int(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "3600"))
+
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "86400"))
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+@app.on_event("startup")
+async def _start_background_tasks() -> None:
+    task = asyncio.create_task(admission_state.monitor_loop_lag())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    if ROLLUP_RECONCILE_INTERVAL_SECONDS > 0:
+        task = asyncio.create_task(
+            run_reconciliation_loop(ROLLUP_RECONCILE_INTERVAL_SECONDS, ROLLUP_RECONCILE_LOOKBACK_DAYS)
+        )
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    if JOB_REAPER_INTERVAL_SECONDS > 0 and JOB_DEADLINE_SECONDS > 0:
+        task = asyncio.create_task(_run_job_reaper())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    if IDEMPOTENCY_PURGE_INTERVAL_SECONDS > 0:
+        task = asyncio.create_task(_run_idempotency_purge())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    if ARCHIVE_INTERVAL_SECONDS > 0:
+        task = asyncio.create_task(run_archive_loop(ARCHIVE_INTERVAL_SECONDS))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+@app.on_event("shutdown")
+async def _stop_background_tasks() -> None:
+    # SIGTERM 時は uvicorn が処理中のリクエストを待ってからここに来る
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.to_thread(job_store.close)
+    stop_logging()
+
 
 def _require_stripe_configuration() -> None:
     if not stripe.api_key:
@@ -68,6 +154,17 @@ def _refund_consumption(
     if consumption.refunded:
         return
 
+    _add_refund(db, consumption, user, reason, request_id)
+    db.commit()
+
+
+def _add_refund(
+    db: Session,
+    consumption: Consumption,
+    user: User,
+    reason: str,
+    request_id: str | None = None,
+) -> None:
     user.credits += consumption.credits_used
     consumption.refunded = True
     refund_entry = Consumption(
@@ -77,30 +174,139 @@ def _refund_consumption(
         request_id=request_id or consumption.request_id,
         refunded=True,
     )
+    record_consumption(db, refund_entry)
     db.add(user)
     db.add(consumption)
     db.add(refund_entry)
-    db.commit()
+
+
+def _refund_by_request_ids(db: Session, request_ids: List[str], reason: str) -> int:
+    """Refund every unrefunded consumption for ``request_ids`` in one transaction (caller commits)."""
+
+    if not request_ids:
+        return 0
+
+    consumptions_stmt = (
+        select(Consumption)
+        .where(
+            Consumption.request_id.in_(request_ids),
+            Consumption.refunded.is_(False),
+            Consumption.credits_used > 0,
+        )
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    consumptions: List[Consumption] = db.execute(consumptions_stmt).scalars().all()
+    if not consumptions:
+        return 0
+
+    users_stmt = (
+        select(User)
+        .where(User.uid.in_({consumption.uid for consumption in consumptions}))
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    users = {user.uid: user for user in db.execute(users_stmt).scalars()}
+
+    refunded = 0
+    for consumption in consumptions:
+        user = users.get(consumption.uid)
+        if user is None:
+            continue
+        _add_refund(db, consumption, user, reason)
+        refunded += 1
+    return refunded
 
 
 def _refund_by_request_id(db: Session, request_id: str, reason: str) -> None:
     if not request_id:
         return
 
-    stmt = select(Consumption).where(Consumption.request_id == request_id)
-    consumption = db.execute(stmt).scalars().first()
-    if not consumption or consumption.refunded:
-        return
+    # リーパーと同じロック付きの経路を通して二重返金を防ぐ
+    if _refund_by_request_ids(db, [request_id], reason):
+        db.commit()
+
+
+async def _expire_job(job, semaphore: asyncio.Semaphore) -> str | None:
+    """Give an overdue job one last upstream check; return the failure message if it must be refunded."""
+
+    async with semaphore:
+        try:
+            async with admission_state.upstream_call():
+                response = await poll_result(job.request_id)
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Final poll for expired job %s failed: %s", job.request_id, exc)
+            response = {}
+
+    result_url = response.get("result_url")
+    if response.get("status") == JobStatus.SUCCESS and result_url:
+        job.mark_success(result_url)
+        job_store.update_job(job)
+        return None
+
+    return response.get("error") or "画像の生成がタイムアウトしました。"
+
+
+def _refund_expired(request_ids: List[str]) -> int:
+    with db_session() as db:
+        return _refund_by_request_ids(db, request_ids, "image_generation_expired")
+
+
+async def _reap_expired_jobs() -> None:
+    now = datetime.utcnow()
+    expired = job_store.list_expired(now - timedelta(seconds=JOB_DEADLINE_SECONDS))
+    # アップロードが終わらなかったジョブは問い合わせ先がないので、失敗にして破棄できるようにする
+    for job in expired:
+        if not job.request_id:
+            job.mark_failure("画像の生成を開始できませんでした。")
+            job_store.update_job(job)
+    expired = [job for job in expired if job.request_id]
+    if expired:
+        semaphore = asyncio.Semaphore(JOB_REAPER_CONCURRENCY)
+        errors = await asyncio.gather(*(_expire_job(job, semaphore) for job in expired))
+        failed = [(job, error) for job, error in zip(expired, errors) if error]
+        if failed:
+            # 返金をコミットしてから失敗にする。返金できなかったジョブは PROCESSING のまま次回やり直す
+            refunded = await asyncio.to_thread(_refund_expired, [job.request_id for job, _ in failed])
+            for job, error in failed:
+                job.mark_failure(error)
+                job_store.update_job(job)
+            logger.info("Expired %d jobs, refunded %d consumptions", len(failed), refunded)
+    job_store.purge_finished(now - timedelta(seconds=JOB_RETENTION_SECONDS))
+
+
+async def _run_job_reaper() -> None:
+    while True:
+        await asyncio.sleep(JOB_REAPER_INTERVAL_SECONDS)
+        try:
+            await _reap_expired_jobs()
+        except Exception:  # noqa: BLE001
+            logger.exception("Job reaper failed")
+
+
+def _purge_idempotency_keys() -> int:
+    with db_session() as db:
+        return idempotency.purge_expired(db)
 
-    user = db.get(User, consumption.uid)
-    if not user:
-        return
 
-    _refund_consumption(db, consumption, user, reason, request_id=request_id)
+async def _run_idempotency_purge() -> None:
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(_purge_idempotency_keys)
+        except Exception:  # noqa: BLE001
+            logger.exception("Idempotency key purge failed")
 
 
 async def _initiate_edit(job, request: EditRequest) -> str:
-    request_id = await send_edit_request(job, request.imageBase64)
+    try:
+        async with admission_state.upstream_call():
+            request_id = await send_edit_request(job, request.imageBase64)
+    except (Exception, asyncio.CancelledError):
+        # アップロードが失敗・中断したジョブは再開できないので、リーパーを待たずに失敗にする
+        job.mark_failure("Failed to initiate request")
+        job_store.update_job(job)
+        raise
     if not request_id:
         job.mark_failure("Failed to initiate request")
         job_store.update_job(job)
@@ -119,6 +325,8 @@ class BodySizeLimitMiddleware(BaseHTTPMiddleware):
         request._body = body
         return await call_next(request)
 app.add_middleware(BodySizeLimitMiddleware)
+# 過負荷時は本文を読む前に /api/generate・/api/edit を 503 で断る（CORS より内側）
+app.add_middleware(AdmissionControlMiddleware)
 
 # ---- CORS (env-driven) ----
 _raw_cors = os.getenv("CORS_ALLOW_ORIGINS")
@@ -159,8 +367,11 @@ app.add_middleware(
   allow_origin_regex=ALLOW_ORIGIN_REGEX,
   allow_credentials=False,
   allow_methods=["GET", "POST", "OPTIONS"],
-  allow_headers=["Authorization", "Content-Type"]
+  allow_headers=["Authorization", "Content-Type", "If-None-Match", "Idempotency-Key"],
+  expose_headers=["ETag", "Retry-After", REQUEST_ID_HEADER]
 )
+# リクエストIDはログの相関用。最も外側で付与する
+app.add_middleware(RequestIdMiddleware)
 
 # HTTPExceptionハンドラー（CORSヘッダーを確実に含める）
 @app.exception_handler(HTTPException)
@@ -187,8 +398,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     error_detail = str(exc)
-    error_trace = traceback.format_exc()
-    print(f"Global error handler: {error_detail}\n{error_trace}")
+    logger.error("Unhandled error: %s", error_detail, exc_info=exc)
     
     # CORSヘッダーを含めたエラーレスポンス
     response = JSONResponse(
@@ -210,16 +420,51 @@ async def global_exception_handler(request: Request, exc: Exception):
     return response
 
 
+def _ledger_etag(uid: str, version: int) -> str:
+    digest = hashlib.sha1(f"{uid}:{version}".encode("utf-8")).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+def _conditional_response(request: Request, response: Response, etag: str) -> Response | None:
+    """Return a 304 when If-None-Match already names ``etag``; otherwise tag ``response``."""
+
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in candidates or etag in candidates:
+            return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
 @app.get("/api/me", response_model=MeResponse)
-def read_me(current_user: User = Depends(get_current_user)) -> MeResponse:
+def read_me(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user_readonly),
+    db: Session = Depends(get_read_db),
+):
+    etag = _ledger_etag(current_user.uid, get_ledger_version(db, current_user.uid))
+    not_modified = _conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
     return MeResponse(uid=current_user.uid, email=current_user.email, credits=current_user.credits)
 
 
 @app.get("/api/me/history", response_model=HistoryResponse)
 def read_history(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
-) -> HistoryResponse:
+    request: Request,
+    response: Response,
+    include_archived: bool = Query(False),
+    current_user: User = Depends(get_current_user_readonly),
+    db: Session = Depends(get_read_db),
+):
+    etag = _ledger_etag(current_user.uid, get_ledger_version(db, current_user.uid))
+    not_modified = _conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
+
     charges_stmt = (
         select(Charge)
         .where(Charge.uid == current_user.uid)
@@ -236,6 +481,30 @@ def read_history(
     charges: List[Charge] = db.execute(charges_stmt).scalars().all()
     consumptions: List[Consumption] = db.execute(consumptions_stmt).scalars().all()
 
+    if include_archived:
+        archived_charges_stmt = (
+            select(ChargeArchive)
+            .where(ChargeArchive.uid == current_user.uid)
+            .order_by(ChargeArchive.created_at.desc())
+            .limit(100)
+        )
+        archived_consumptions_stmt = (
+            select(ConsumptionArchive)
+            .where(ConsumptionArchive.uid == current_user.uid)
+            .order_by(ConsumptionArchive.created_at.desc())
+            .limit(100)
+        )
+        charges = sorted(
+            [*charges, *db.execute(archived_charges_stmt).scalars().all()],
+            key=lambda row: row.created_at,
+            reverse=True,
+        )[:100]
+        consumptions = sorted(
+            [*consumptions, *db.execute(archived_consumptions_stmt).scalars().all()],
+            key=lambda row: row.created_at,
+            reverse=True,
+        )[:100]
+
     return HistoryResponse(
         charges=[
             {
@@ -263,15 +532,143 @@ def read_history(
     )
 
 
+@app.get("/api/me/results.zip")
+async def download_results_zip(
+    request_ids: List[str] | None = Query(None),
+    limit: int = Query(20, ge=1, le=ZIP_MAX_JOBS),
+    current_user: User = Depends(get_current_user_readonly),
+) -> StreamingResponse:
+    jobs = job_store.list_finished(current_user.uid, request_ids=request_ids, limit=limit)
+    if not jobs:
+        raise HTTPException(status_code=404, detail="No finished results to download")
+
+    return StreamingResponse(
+        stream_results_zip(jobs),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="eternalai-results.zip"'},
+    )
+
+
+@app.get("/api/me/summary", response_model=SummaryResponse)
+def read_summary(
+    days: int = Query(30, ge=1, le=366),
+    current_user: User = Depends(get_current_user_readonly),
+    db: Session = Depends(get_read_db),
+) -> SummaryResponse:
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    rows: List[DailyUserUsage] = (
+        db.execute(
+            select(DailyUserUsage)
+            .where(DailyUserUsage.uid == current_user.uid, DailyUserUsage.day >= since)
+            .order_by(DailyUserUsage.day.desc())
+        )
+        .scalars()
+        .all()
+    )
+
+    return SummaryResponse(
+        uid=current_user.uid,
+        email=current_user.email,
+        credits=current_user.credits,
+        days=days,
+        totals=usage_totals(rows),
+        daily=[
+            {"day": row.day, **{name: getattr(row, name) for name in USAGE_FIELDS}}
+            for row in rows
+        ],
+    )
+
+
+@app.get("/api/admin/stats", response_model=AdminStatsResponse)
+def read_admin_stats(
+    days: int = Query(30, ge=1, le=366),
+    _admin: User = Depends(get_admin_user),
+    db: Session = Depends(get_read_db),
+) -> AdminStatsResponse:
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    rows: List[DailyUsage] = (
+        db.execute(
+            select(DailyUsage).where(DailyUsage.day >= since).order_by(DailyUsage.day.desc())
+        )
+        .scalars()
+        .all()
+    )
+
+    return AdminStatsResponse(
+        days=days,
+        totals=usage_totals(rows),
+        daily=[
+            {"day": row.day, **{name: getattr(row, name) for name in USAGE_FIELDS}}
+            for row in rows
+        ],
+    )
+
+
+@app.get("/api/admin/export")
+def export_ledger(
+    table: str = Query(..., description="charges または consumptions"),
+    fmt: str = Query("ndjson", alias="format"),
+    start: datetime | None = Query(None),
+    end: datetime | None = Query(None),
+    uid: str | None = Query(None),
+    include_archived: bool = Query(False),
+    _admin: User = Depends(get_admin_user),
+) -> StreamingResponse:
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=400, detail="Invalid table")
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format")
+
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    filename = f"{table}.{fmt}"
+    # 同期ジェネレータなのでスレッドプールで回り、イベントループを塞がない
+    return StreamingResponse(
+        iter_export(table, fmt, start, end, uid, include_archived=include_archived),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @app.post("/api/payment/create-checkout-session", response_model=CheckoutSessionResponse)
 def create_checkout_session(
     payload: CheckoutSessionRequest,
     current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    idempotency_key: str | None = Header(default=None),
 ) -> CheckoutSessionResponse:
     _require_stripe_configuration()
     if payload.price_id not in PRICE_TO_CREDITS:
         raise HTTPException(status_code=400, detail="Invalid price identifier")
 
+    if not idempotency_key:
+        return _create_checkout_session(payload, current_user)
+
+    scope = "checkout"
+    stored = idempotency.begin_sync(
+        db,
+        scope,
+        current_user.uid,
+        idempotency_key,
+        idempotency.fingerprint(payload.price_id, payload.quantity),
+    )
+    if stored is not None:
+        return CheckoutSessionResponse(**stored)
+    try:
+        response = _create_checkout_session(
+            payload, current_user, stripe_idempotency_key=f"{scope}:{current_user.uid}:{idempotency_key}"
+        )
+    except Exception:
+        idempotency.release(db, scope, current_user.uid, idempotency_key)
+        raise
+    idempotency.complete(db, scope, current_user.uid, idempotency_key, response.dict())
+    return response
+
+
+def _create_checkout_session(
+    payload: CheckoutSessionRequest,
+    current_user: User,
+    stripe_idempotency_key: str | None = None,
+) -> CheckoutSessionResponse:
     try:
         session = stripe.checkout.Session.create(
             mode="payment",
@@ -284,9 +681,10 @@ def create_checkout_session(
                 "environment": os.getenv("ENVIRONMENT", "development"),
             },
             customer_email=current_user.email,
+            idempotency_key=stripe_idempotency_key,
         )
     except stripe.error.StripeError as exc:  # type: ignore[attr-defined]
-        print(f"Stripe error while creating session: {exc}")
+        logger.error("Stripe error while creating session: %s", exc)
         raise HTTPException(status_code=502, detail="Failed to create checkout session") from exc
 
     url = session.get("url")
@@ -334,7 +732,7 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
                 session_obj["id"], limit=100
             )
         except stripe.error.StripeError as exc:  # type: ignore[attr-defined]
-            print(f"Stripe error while fetching line items: {exc}")
+            logger.error("Stripe error while fetching line items: %s", exc)
             raise HTTPException(status_code=502, detail="Failed to fetch line items") from exc
 
         total_credits = 0
@@ -364,6 +762,8 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
                 email = customer_details.get("email")
             user = User(uid=client_reference_id, email=email, credits=0)
             db.add(user)
+            # 集計テーブルは users.uid を参照するので、先にユーザーを INSERT しておく
+            db.flush()
 
         user.credits += total_credits
 
@@ -376,6 +776,7 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
             amount_total_jpy=int(session_obj.get("amount_total") or 0),
             currency=session_obj.get("currency") or "jpy",
         )
+        record_charge(db, charge)
         db.add(charge)
         db.add(user)
         db.commit()
@@ -388,7 +789,39 @@ async def generate_image(
     request: EditRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
+    idempotency_key: str | None = Header(default=None),
 ) -> EditResponse:
+    if not idempotency_key:
+        return await _run_generation(request, current_user, db)
+
+    # 同じキーの再送は課金・外部APIを再実行せずに保存済みのレスポンスを返す
+    scope = "generate"
+    stored = await idempotency.begin(
+        db,
+        scope,
+        current_user.uid,
+        idempotency_key,
+        idempotency.fingerprint(
+            request.prompt,
+            request.filename,
+            idempotency.digest_text(request.imageBase64),
+        ),
+    )
+    if stored is not None:
+        return EditResponse(**stored)
+    try:
+        response = await _run_generation(request, current_user, db)
+    except Exception:
+        idempotency.release(db, scope, current_user.uid, idempotency_key)
+        raise
+    idempotency.complete(db, scope, current_user.uid, idempotency_key, response.dict())
+    return response
+
+
+async def _run_generation(request: EditRequest, current_user: User, db: Session) -> EditResponse:
+    if GENERATION_PIPELINED:
+        return await _run_generation_pipelined(request, current_user, db)
+
     user = db.get(User, current_user.uid)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
@@ -403,6 +836,7 @@ async def generate_image(
         reason="image_generation",
         refunded=False,
     )
+    record_consumption(db, consumption)
     db.add(user)
     db.add(consumption)
     db.commit()
@@ -418,16 +852,97 @@ async def generate_image(
         request_id = await _initiate_edit(job, request)
         consumption.request_id = request_id
         db.add(consumption)
+        bump_ledger_version(db, user.uid)
         db.commit()
         return EditResponse(request_id=request_id)
     except HTTPException as exc:
         _refund_consumption(db, consumption, user, "image_generation_refund")
         raise exc
     except Exception as exc:  # noqa: BLE001
-        print(f"Error initiating generation: {exc}")
+        logger.exception("Error initiating generation")
         _refund_consumption(db, consumption, user, "image_generation_refund")
         raise HTTPException(status_code=500, detail="Internal server error") from exc
 
+
+def _reserve_credits(uid: str, cost: int) -> int | None:
+    """Atomically debit ``cost`` credits; return the consumption id, or None if the balance is short."""
+
+    with db_session() as db:
+        result = db.execute(
+            update(User)
+            .where(User.uid == uid, User.credits >= cost)
+            .values(credits=User.credits - cost)
+        )
+        if result.rowcount != 1:
+            return None
+        consumption = Consumption(
+            uid=uid,
+            credits_used=cost,
+            reason="image_generation",
+            refunded=False,
+        )
+        record_consumption(db, consumption)
+        db.add(consumption)
+        db.flush()
+        return consumption.id
+
+
+async def _run_generation_pipelined(request: EditRequest, current_user: User, db: Session) -> EditResponse:
+    """Reserve credits and upload to EternalAI concurrently; undo whichever side succeeded if the other fails.
+
+    The reservation is a conditional UPDATE, so concurrent requests can never spend
+    more than the balance.
+    """
+
+    if current_user.credits < DEFAULT_GENERATION_COST:
+        raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Insufficient credits")
+
+    job = job_store.create_job(
+        filename=request.filename,
+        prompt=request.prompt,
+        uid=current_user.uid,
+    )
+    reserve = asyncio.create_task(
+        asyncio.to_thread(_reserve_credits, current_user.uid, DEFAULT_GENERATION_COST)
+    )
+    submit = asyncio.create_task(_initiate_edit(job, request))
+
+    await asyncio.wait({reserve, submit}, return_when=asyncio.FIRST_COMPLETED)
+    if reserve.done() and reserve.exception() is None and reserve.result() is None and not submit.done():
+        # 残高不足が先に判明したらアップロードを打ち切る
+        submit.cancel()
+    await asyncio.wait({reserve, submit})
+
+    consumption_id = None if reserve.cancelled() or reserve.exception() else reserve.result()
+    submit_error = None if submit.cancelled() else submit.exception()
+
+    if consumption_id is None:
+        if job.status == JobStatus.PROCESSING:
+            job.mark_failure("Insufficient credits")
+            job_store.update_job(job)
+        if reserve.exception() is not None:
+            logger.error("Error reserving credits", exc_info=reserve.exception())
+            raise HTTPException(status_code=500, detail="Internal server error")
+        raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Insufficient credits")
+
+    # 予約は別セッションでコミット済みなので、このセッションに残る古い状態を読み直す
+    consumption = db.get(Consumption, consumption_id, populate_existing=True)
+    user = db.get(User, current_user.uid, populate_existing=True, with_for_update=True)
+    if submit_error is not None:
+        _refund_consumption(db, consumption, user, "image_generation_refund")
+        if isinstance(submit_error, HTTPException):
+            raise submit_error
+        logger.error("Error initiating generation", exc_info=submit_error)
+        raise HTTPException(status_code=500, detail="Internal server error") from submit_error
+
+    request_id = submit.result()
+    consumption.request_id = request_id
+    db.add(consumption)
+    bump_ledger_version(db, user.uid)
+    db.commit()
+    return EditResponse(request_id=request_id)
+
+
 @app.post("/api/edit", response_model=EditResponse)
 async def create_edit(request: EditRequest) -> EditResponse:
     try:
@@ -438,8 +953,7 @@ async def create_edit(request: EditRequest) -> EditResponse:
         raise
     except Exception as e:
         error_detail = str(e)
-        error_trace = traceback.format_exc()
-        print(f"Error in /api/edit: {error_detail}\n{error_trace}")
+        logger.exception("Error in /api/edit")
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error: {error_detail}"
@@ -447,6 +961,7 @@ async def create_edit(request: EditRequest) -> EditResponse:
 
 @app.get("/api/poll", response_model=PollResponse)
 async def get_result(
+    http_response: Response,
     request_id: str = Query(..., description="EternalAI request identifier"),
     db: Session = Depends(get_db),
 ) -> PollResponse:
@@ -454,36 +969,52 @@ async def get_result(
         job = job_store.get_job(request_id)
         if job and job.status == JobStatus.SUCCESS and job.result_url:
             return PollResponse(status=JobStatus.SUCCESS, result_url=job.result_url, request_id=request_id)
+        # 失敗済み（期限切れで返金済みを含む）なら外部に問い合わせない
+        if job and job.status == JobStatus.FAILED:
+            return PollResponse(status=JobStatus.FAILED, error=job.error, request_id=request_id)
 
         # 外部をポーリング
-        response = await poll_result(request_id)
+        polled_at = datetime.utcnow()
+        async with admission_state.upstream_call():
+            response = await poll_result(request_id)
         status = response.get("status")
 
         if status == JobStatus.SUCCESS:
             result_url = response.get("result_url")
             if job and result_url:
+                was_processing = job.status == JobStatus.PROCESSING
                 job.mark_success(result_url)
                 job_store.update_job(job)
+                if was_processing:
+                    completion_times.record(job)
             return PollResponse(status=JobStatus.SUCCESS, result_url=result_url, request_id=request_id)
 
         if status == JobStatus.FAILED:
             error = response.get("error", "画像の生成に失敗しました。")
 
+            # 返金をコミットしてから失敗にする（失敗済みのジョブは再ポーリングされないため）
+            _refund_by_request_id(db, request_id, "image_generation_failed")
             if job:
                 job.mark_failure(error)
                 job_store.update_job(job)
-
-            _refund_by_request_id(db, request_id, "image_generation_failed")
             return PollResponse(status=JobStatus.FAILED, error=error, request_id=request_id)
 
         # 既知のrequest_idでjobが無い＝スリープ等で消えた可能性
-        return PollResponse(status=JobStatus.PROCESSING, request_id=request_id)
+        # 過去の完了時間の分布から、次に確認すべきタイミングを返す
+        completion_times.note_pending(job, polled_at)
+        estimated_completion_at, retry_after_ms = completion_times.hint(job)
+        http_response.headers["Retry-After"] = str(math.ceil(retry_after_ms / 1000))
+        return PollResponse(
+            status=JobStatus.PROCESSING,
+            request_id=request_id,
+            estimated_completion_at=estimated_completion_at,
+            retry_after_ms=retry_after_ms,
+        )
     except HTTPException:
         raise
     except Exception as e:
         error_detail = str(e)
-        error_trace = traceback.format_exc()
-        print(f"Error in /api/poll: {error_detail}\n{error_trace}")
+        logger.exception("Error in /api/poll")
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error: {error_detail}"
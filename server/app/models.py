@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import date, datetime
 from enum import Enum
 from typing import List, Optional
 from pydantic import BaseModel, Field
@@ -25,6 +25,8 @@ class PollResponse(BaseModel):
   result_url: Optional[str] = None
   error: Optional[str] = None
   request_id: Optional[str] = None
+  estimated_completion_at: Optional[datetime] = None
+  retry_after_ms: Optional[int] = None
 
 
 class CheckoutSessionRequest(BaseModel):
@@ -66,6 +68,35 @@ class HistoryResponse(BaseModel):
   consumptions: List[ConsumptionLog]
 
 
+class UsageTotals(BaseModel):
+  credits_purchased: int = 0
+  amount_total_jpy: int = 0
+  charge_count: int = 0
+  credits_consumed: int = 0
+  generation_count: int = 0
+  credits_refunded: int = 0
+  refund_count: int = 0
+
+
+class DailyUsageLog(UsageTotals):
+  day: date
+
+
+class SummaryResponse(BaseModel):
+  uid: str
+  email: Optional[str]
+  credits: int
+  days: int
+  totals: UsageTotals
+  daily: List[DailyUsageLog]
+
+
+class AdminStatsResponse(BaseModel):
+  days: int
+  totals: UsageTotals
+  daily: List[DailyUsageLog]
+
+
 class Job(BaseModel):
   id: str
   request_id: Optional[str] = None
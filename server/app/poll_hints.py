@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import math
+import os
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Deque, List, Optional
+
+from .models import Job
+
+
+POLL_HINT_WINDOW = int(os.getenv("POLL_HINT_WINDOW", "200"))
+POLL_HINT_MIN_SAMPLES = int(os.getenv("POLL_HINT_MIN_SAMPLES", "5"))
+POLL_HINT_DEFAULT_MS = int(os.getenv("POLL_HINT_DEFAULT_MS", "2000"))
+POLL_HINT_MIN_MS = int(os.getenv("POLL_HINT_MIN_MS", "500"))
+POLL_HINT_MAX_MS = int(os.getenv("POLL_HINT_MAX_MS", "10000"))
+
+# 経過時間がこの順に各分位点を超えたら次の分位点を完了予定とみなす
+_QUANTILES = (0.5, 0.75, 0.9, 0.99)
+# 直前の「処理中」応答の時刻を覚えておくジョブ数の上限（失敗・放置されたジョブで溜まらないように）
+_MAX_TRACKED_JOBS = 10000
+
+
+class CompletionTimeTracker:
+    """Rolling window of EternalAI completion times, measured from ``created_at``.
+
+    ``completed_at`` is stamped by the poll that first sees success, so the job
+    really finished somewhere between the previous (still processing) poll and
+    that one. Sampling the midpoint keeps the hints we serve from feeding back
+    into the distribution and pushing it upward.
+    """
+
+    def __init__(self, window: int = POLL_HINT_WINDOW) -> None:
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._last_pending: OrderedDict[str, datetime] = OrderedDict()
+        self._lock = Lock()
+
+    def note_pending(self, job: Optional[Job], polled_at: datetime) -> None:
+        """Remember that upstream still reported ``job`` as processing at ``polled_at``."""
+
+        if job is None:
+            return
+        with self._lock:
+            self._last_pending[job.id] = polled_at
+            self._last_pending.move_to_end(job.id)
+            if len(self._last_pending) > _MAX_TRACKED_JOBS:
+                self._last_pending.popitem(last=False)
+
+    def record(self, job: Job) -> None:
+        if job.completed_at is None:
+            return
+        with self._lock:
+            last_pending = self._last_pending.pop(job.id, job.created_at)
+            finished_at = last_pending + (job.completed_at - last_pending) / 2
+            seconds = (finished_at - job.created_at).total_seconds()
+            if seconds >= 0:
+                self._samples.append(seconds)
+
+    def _sorted_samples(self) -> List[float]:
+        with self._lock:
+            return sorted(self._samples)
+
+    def hint(self, job: Optional[Job]) -> tuple[Optional[datetime], int]:
+        """Return (estimated completion time, milliseconds until the next poll is worthwhile)."""
+
+        samples = self._sorted_samples()
+        if job is None or len(samples) < POLL_HINT_MIN_SAMPLES:
+            return None, POLL_HINT_DEFAULT_MS
+
+        elapsed = (datetime.utcnow() - job.created_at).total_seconds()
+        for quantile in _QUANTILES:
+            expected = samples[min(len(samples) - 1, math.ceil(quantile * len(samples)) - 1)]
+            if (expected - elapsed) * 1000 > POLL_HINT_MIN_MS:
+                retry_after_ms = int((expected - elapsed) * 1000)
+                estimated = job.created_at + timedelta(seconds=expected)
+                return estimated, max(POLL_HINT_MIN_MS, min(POLL_HINT_MAX_MS, retry_after_ms))
+
+        # 分布の裾を超えている場合は既定の間隔で確認を続ける
+        return None, POLL_HINT_DEFAULT_MS
+
+
+completion_times = CompletionTimeTracker()
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .database import db_session
+from .db_models import (
+    Charge,
+    ChargeArchive,
+    Consumption,
+    ConsumptionArchive,
+    DailyUsage,
+    DailyUserUsage,
+    LedgerVersion,
+    User,
+)
+
+
+logger = logging.getLogger(__name__)
+
+USAGE_FIELDS = (
+    "credits_purchased",
+    "amount_total_jpy",
+    "charge_count",
+    "credits_consumed",
+    "generation_count",
+    "credits_refunded",
+    "refund_count",
+)
+
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _increment(db: Session, model, keys: Dict, deltas: Dict[str, int]) -> None:
+    table = model.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = pg_insert if dialect == "postgresql" else sqlite_insert
+        stmt = insert(table).values(**keys, **deltas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: table.c[name] + stmt.excluded[name] for name in deltas},
+        )
+        db.execute(stmt)
+        return
+
+    # その他のDBは行ロックを取ってから加算する
+    row = db.get(model, tuple(keys.values()), with_for_update=True)
+    if row is None:
+        row = model(**keys, **{name: 0 for name in deltas})
+        db.add(row)
+    for name, delta in deltas.items():
+        setattr(row, name, getattr(row, name) + delta)
+
+
+def _apply(db: Session, uid: str, day: date, deltas: Dict[str, int]) -> None:
+    _increment(db, DailyUserUsage, {"uid": uid, "day": day}, deltas)
+    _increment(db, DailyUsage, {"day": day}, deltas)
+    bump_ledger_version(db, uid)
+
+
+def bump_ledger_version(db: Session, uid: str) -> None:
+    """Mark the user's ledger as changed (drives the ETag of /api/me and /api/me/history)."""
+
+    _increment(db, LedgerVersion, {"uid": uid}, {"version": 1})
+
+
+def get_ledger_version(db: Session, uid: str) -> int:
+    row = db.get(LedgerVersion, uid)
+    return row.version if row else 0
+
+
+def record_charge(db: Session, charge: Charge) -> None:
+    """Add a charge to the daily rollups within the caller's transaction."""
+
+    if charge.created_at is None:
+        charge.created_at = datetime.utcnow()
+    _apply(
+        db,
+        charge.uid,
+        charge.created_at.date(),
+        {
+            "credits_purchased": charge.credits_added,
+            "amount_total_jpy": charge.amount_total_jpy,
+            "charge_count": 1,
+        },
+    )
+
+
+def record_consumption(db: Session, consumption: Consumption) -> None:
+    """Add a consumption (or refund entry) to the daily rollups within the caller's transaction."""
+
+    if consumption.created_at is None:
+        consumption.created_at = datetime.utcnow()
+    if consumption.credits_used >= 0:
+        deltas = {"credits_consumed": consumption.credits_used, "generation_count": 1}
+    else:
+        deltas = {"credits_refunded": -consumption.credits_used, "refund_count": 1}
+    _apply(db, consumption.uid, consumption.created_at.date(), deltas)
+
+
+def rebuild_rollups(db: Session, since: Optional[date] = None) -> None:
+    """Recompute rollup rows from the raw ledger tables (all days, or ``since`` onwards)."""
+
+    start = datetime.combine(since, datetime.min.time()) if since else None
+    user_delete = delete(DailyUserUsage)
+    global_delete = delete(DailyUsage)
+    if since:
+        user_delete = user_delete.where(DailyUserUsage.day >= since)
+        global_delete = global_delete.where(DailyUsage.day >= since)
+    db.execute(user_delete)
+    db.execute(global_delete)
+
+    rows: Dict[tuple, Dict[str, int]] = {}
+
+    def _row(uid: str, day) -> Dict[str, int]:
+        return rows.setdefault((uid, _as_date(day)), {name: 0 for name in USAGE_FIELDS})
+
+    # アーカイブ済みの行も集計に含める
+    for charges in (Charge.__table__, ChargeArchive.__table__):
+        charge_day = func.date(charges.c.created_at)
+        charges_stmt = select(
+            charges.c.uid,
+            charge_day,
+            func.coalesce(func.sum(charges.c.credits_added), 0),
+            func.coalesce(func.sum(charges.c.amount_total_jpy), 0),
+            func.count(),
+        ).group_by(charges.c.uid, charge_day)
+        if start:
+            charges_stmt = charges_stmt.where(charges.c.created_at >= start)
+        for uid, day, credits, amount, count in db.execute(charges_stmt):
+            row = _row(uid, day)
+            row["credits_purchased"] += credits
+            row["amount_total_jpy"] += amount
+            row["charge_count"] += count
+
+    for consumptions in (Consumption.__table__, ConsumptionArchive.__table__):
+        consumption_day = func.date(consumptions.c.created_at)
+        is_refund = consumptions.c.credits_used < 0
+        consumptions_stmt = select(
+            consumptions.c.uid,
+            consumption_day,
+            is_refund,
+            func.coalesce(func.sum(consumptions.c.credits_used), 0),
+            func.count(),
+        ).group_by(consumptions.c.uid, consumption_day, is_refund)
+        if start:
+            consumptions_stmt = consumptions_stmt.where(consumptions.c.created_at >= start)
+        for uid, day, refund, credits, count in db.execute(consumptions_stmt):
+            row = _row(uid, day)
+            if refund:
+                row["credits_refunded"] += -credits
+                row["refund_count"] += count
+            else:
+                row["credits_consumed"] += credits
+                row["generation_count"] += count
+
+    daily: Dict[date, Dict[str, int]] = {}
+    for (uid, day), values in rows.items():
+        db.add(DailyUserUsage(uid=uid, day=day, **values))
+        totals = daily.setdefault(day, {name: 0 for name in USAGE_FIELDS})
+        for name, value in values.items():
+            totals[name] += value
+    for day, values in daily.items():
+        db.add(DailyUsage(day=day, **values))
+
+
+def find_balance_mismatches(db: Session) -> List[Dict]:
+    """Compare each user's rollup balance with ``User.credits``."""
+
+    stmt = (
+        select(
+            User.uid,
+            User.credits,
+            func.coalesce(
+                func.sum(
+                    DailyUserUsage.credits_purchased
+                    - DailyUserUsage.credits_consumed
+                    + DailyUserUsage.credits_refunded
+                ),
+                0,
+            ),
+        )
+        .outerjoin(DailyUserUsage, DailyUserUsage.uid == User.uid)
+        .group_by(User.uid, User.credits)
+    )
+    return [
+        {"uid": uid, "credits": credits, "expected_credits": expected}
+        for uid, credits, expected in db.execute(stmt)
+        if credits != expected
+    ]
+
+
+def reconcile(lookback_days: int = 2) -> List[Dict]:
+    """Rebuild the most recent rollup days from the ledger and report balance drift."""
+
+    since: Optional[date] = datetime.utcnow().date() - timedelta(days=lookback_days)
+    with db_session() as db:
+        # 初回（ロールアップが空）は全期間を集計し直す
+        if db.execute(select(DailyUsage.day).limit(1)).first() is None:
+            since = None
+        rebuild_rollups(db, since=since)
+        db.flush()
+        mismatches = find_balance_mismatches(db)
+    for mismatch in mismatches:
+        logger.warning("Rollup reconciliation mismatch", extra=mismatch)
+    return mismatches
+
+
+async def run_reconciliation_loop(interval_seconds: int, lookback_days: int) -> None:
+    while True:
+        try:
+            await asyncio.to_thread(reconcile, lookback_days)
+        except Exception:  # noqa: BLE001
+            logger.exception("Rollup reconciliation failed")
+        await asyncio.sleep(interval_seconds)
+
+
+def usage_totals(rows) -> Dict[str, int]:
+    totals = {name: 0 for name in USAGE_FIELDS}
+    for row in rows:
+        for name in USAGE_FIELDS:
+            totals[name] += getattr(row, name)
+    return totals
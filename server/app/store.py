@@ -1,18 +1,180 @@
 from __future__ import annotations
 
-from typing import Dict, Optional
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional
 from datetime import datetime
 from uuid import uuid4
-from threading import Lock
+from threading import Event, Lock, Thread
 
 from .models import Job, JobStatus
 
 
+logger = logging.getLogger(__name__)
+
+class JobJournal:
+  """Append-only job log, written in batches by a background thread.
+
+  The hot path only appends a line to an in-memory buffer. Every
+  ``flush_interval`` seconds the buffer is written (and fsynced) in one go, and once
+  the file holds many more records than live jobs it is rewritten from a snapshot.
+  """
+
+  def __init__(
+    self,
+    path: str,
+    flush_interval: float = 0.5,
+    compact_threshold: int = 10000,
+    fsync: bool = True,
+  ) -> None:
+    self.path = path
+    self._flush_interval = flush_interval
+    self._compact_threshold = compact_threshold
+    self._fsync = fsync
+    self._buffer: List[str] = []
+    self._lock = Lock()
+    self._records = 0
+    self._stop = Event()
+    self._snapshot: Optional[Callable[[], List[str]]] = None
+    self._live_count: Callable[[], int] = lambda: 0
+    self._file = None
+    self._thread: Optional[Thread] = None
+
+  def replay(self) -> Dict[str, Job]:
+    """Rebuild the job table with one sequential read of the journal."""
+
+    jobs: Dict[str, Job] = {}
+    if not os.path.exists(self.path):
+      return jobs
+    with open(self.path, 'r', encoding='utf-8') as handle:
+      for line in handle:
+        try:
+          record = json.loads(line)
+        except json.JSONDecodeError:
+          # 書き込み途中で落ちた末尾の行は読み飛ばす
+          continue
+        self._records += 1
+        if record.get('op') == 'put':
+          job = Job.parse_obj(record['job'])
+          jobs[job.id] = job
+        elif record.get('op') == 'del':
+          jobs.pop(record.get('id'), None)
+    return jobs
+
+  def start(self, snapshot: Callable[[], List[str]], live_count: Callable[[], int]) -> None:
+    self._snapshot = snapshot
+    self._live_count = live_count
+    directory = os.path.dirname(self.path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self._file = open(self.path, 'a', encoding='utf-8')
+    self._thread = Thread(target=self._run, name='job-journal', daemon=True)
+    self._thread.start()
+
+  @staticmethod
+  def put_record(job: Job) -> str:
+    return f'{{"op": "put", "job": {job.json()}}}\n'
+
+  def put(self, job: Job) -> None:
+    line = self.put_record(job)
+    with self._lock:
+      self._buffer.append(line)
+
+  def delete(self, job_id: str) -> None:
+    line = json.dumps({'op': 'del', 'id': job_id}) + '\n'
+    with self._lock:
+      self._buffer.append(line)
+
+  def discard_pending(self) -> None:
+    """Drop buffered records; only valid while the caller holds a snapshot covering them."""
+
+    with self._lock:
+      self._buffer.clear()
+
+  def _run(self) -> None:
+    while not self._stop.wait(self._flush_interval):
+      try:
+        self.flush()
+        if self._records > max(self._compact_threshold, self._live_count() * 2):
+          self.compact()
+      except OSError as exc:
+        logger.error("Job journal write failed: %s", exc)
+
+  def flush(self) -> None:
+    with self._lock:
+      lines, self._buffer = self._buffer, []
+    if not lines or self._file is None:
+      return
+    self._file.write(''.join(lines))
+    self._file.flush()
+    if self._fsync:
+      os.fsync(self._file.fileno())
+    self._records += len(lines)
+
+  def compact(self) -> None:
+    """Rewrite the journal as one ``put`` per live job."""
+
+    if self._snapshot is None:
+      return
+    lines = self._snapshot()
+    tmp_path = f'{self.path}.compact'
+    with open(tmp_path, 'w', encoding='utf-8') as handle:
+      handle.write(''.join(lines))
+      handle.flush()
+      os.fsync(handle.fileno())
+    if self._file is not None:
+      self._file.close()
+    os.replace(tmp_path, self.path)
+    self._file = open(self.path, 'a', encoding='utf-8')
+    self._records = len(lines)
+
+  def close(self) -> None:
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+    self.flush()
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+
 class InMemoryJobStore:
-  def __init__(self) -> None:
+  def __init__(self, journal: Optional[JobJournal] = None) -> None:
     self._jobs: Dict[str, Job] = {}
     self._lock = Lock()
     self._jobs_by_request: Dict[str, Job] = {}
+    self._journal = journal
+    if journal is not None:
+      interrupted = self._restore(journal.replay())
+      journal.start(self._snapshot_records, lambda: len(self._jobs))
+      for job in interrupted:
+        journal.put(job)
+
+  def _restore(self, jobs: Dict[str, Job]) -> List[Job]:
+    """Load replayed jobs; return the ones whose upload was cut off by the restart, now failed."""
+
+    # request_id の無い処理中ジョブはアップロード中に落ちたもので再開できない
+    interrupted = [
+      job for job in jobs.values()
+      if job.status == JobStatus.PROCESSING and not job.request_id
+    ]
+    for job in interrupted:
+      job.mark_failure('サーバーの再起動により画像の生成を開始できませんでした。')
+    with self._lock:
+      self._jobs = jobs
+      self._jobs_by_request = {job.request_id: job for job in jobs.values() if job.request_id}
+    return interrupted
+
+  def _snapshot_records(self) -> List[str]:
+    # ストアのロック中にバッファを空にすることで、スナップショットとの重複・欠落を防ぐ
+    with self._lock:
+      self._journal.discard_pending()
+      return [JobJournal.put_record(job) for job in self._jobs.values()]
+
+  def _journal_put(self, job: Job) -> None:
+    if self._journal is not None:
+      self._journal.put(job)
 
   def create_job(self, filename: str, prompt: str, uid: str | None = None) -> Job:
     job_id = uuid4().hex
@@ -26,6 +188,7 @@ class InMemoryJobStore:
     )
     with self._lock:
       self._jobs[job_id] = job
+      self._journal_put(job)
     return job
 
   def attach_request_id(self, job: Job, request_id: str) -> None:
@@ -33,12 +196,14 @@ class InMemoryJobStore:
     with self._lock:
       self._jobs[job.id] = job
       self._jobs_by_request[request_id] = job
+      self._journal_put(job)
 
   def update_job(self, job: Job) -> None:
     with self._lock:
       self._jobs[job.id] = job
       if job.request_id:
         self._jobs_by_request[job.request_id] = job
+      self._journal_put(job)
 
   def get_job(self, job_id: str) -> Optional[Job]:
     with self._lock:
@@ -47,5 +212,59 @@ class InMemoryJobStore:
         return job
       return self._jobs.get(job_id)
 
+  def list_finished(self, uid: str, request_ids: Optional[List[str]] = None, limit: int = 20) -> List[Job]:
+    """Most recent successful jobs of ``uid`` (optionally only ``request_ids``), newest first."""
+
+    with self._lock:
+      if request_ids:
+        candidates = [self._jobs_by_request.get(request_id) or self._jobs.get(request_id) for request_id in request_ids]
+      else:
+        candidates = list(self._jobs.values())
+    jobs = [
+      job for job in candidates
+      if job and job.uid == uid and job.status == JobStatus.SUCCESS and job.result_url
+    ]
+    jobs.sort(key=lambda job: job.completed_at or job.created_at, reverse=True)
+    return jobs[:limit]
+
+  def list_expired(self, created_before: datetime) -> List[Job]:
+    with self._lock:
+      return [
+        job for job in self._jobs.values()
+        if job.status == JobStatus.PROCESSING and job.created_at < created_before
+      ]
+
+  def purge_finished(self, completed_before: datetime) -> int:
+    with self._lock:
+      stale = [
+        job for job in self._jobs.values()
+        if job.status != JobStatus.PROCESSING and job.completed_at and job.completed_at < completed_before
+      ]
+      for job in stale:
+        self._jobs.pop(job.id, None)
+        if job.request_id:
+          self._jobs_by_request.pop(job.request_id, None)
+        if self._journal is not None:
+          self._journal.delete(job.id)
+    return len(stale)
+
+  def close(self) -> None:
+    """Flush the journal (if any); called on shutdown."""
+
+    if self._journal is not None:
+      self._journal.close()
+
+
+def _journal_from_env() -> Optional[JobJournal]:
+  path = os.getenv('JOB_JOURNAL_PATH')
+  if not path:
+    return None
+  return JobJournal(
+    path,
+    flush_interval=float(os.getenv('JOB_JOURNAL_FLUSH_INTERVAL', '0.5')),
+    compact_threshold=int(os.getenv('JOB_JOURNAL_COMPACT_THRESHOLD', '10000')),
+    fsync=os.getenv('JOB_JOURNAL_FSYNC', 'true').lower() not in ('0', 'false', 'no'),
+  )
+
 
-job_store = InMemoryJobStore()
+job_store = InMemoryJobStore(journal=_journal_from_env())
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+import httpx
+
+from .config import Settings
+
+
+logger = logging.getLogger(__name__)
+
+REDACTED = '<redacted>'
+# 再生中のジョブ状態をこの時間（実時間）で捨てる
+_REPLAY_STATE_TTL_SECONDS = 3600
+_TERMINAL_STATUSES = ('success', 'failed')
+_DECODED_BODY_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+_REPLAY_PLACEHOLDER = 'data:text/plain;base64,' + base64.b64encode(b'Replayed EternalAI result').decode('ascii')
+
+
+def _redact(value: Any) -> Any:
+  """Keep the JSON shape but drop image payloads and URLs."""
+
+  if isinstance(value, dict):
+    return {key: _redact(item) for key, item in value.items()}
+  if isinstance(value, list):
+    return [_redact(item) for item in value]
+  if isinstance(value, str) and (value.startswith('data:') or value.startswith('http')):
+    return REDACTED
+  return value
+
+
+def _hash_id(request_id: Optional[str]) -> Optional[str]:
+  if not request_id:
+    return None
+  return hashlib.sha1(request_id.encode('utf-8')).hexdigest()[:16]
+
+
+def _kind(request: httpx.Request) -> str:
+  return 'edit' if request.method == 'POST' else 'poll'
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+  """Pass requests through to EternalAI and append timing + redacted shapes to a JSONL file."""
+
+  def __init__(self, path: str) -> None:
+    self._path = path
+    self._inner = httpx.AsyncHTTPTransport()
+
+  def _append(self, entry: Dict[str, Any]) -> None:
+    with open(self._path, 'a', encoding='utf-8') as handle:
+      handle.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+  async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+    entry: Dict[str, Any] = {
+      'kind': _kind(request),
+      'recorded_at': time.time(),
+      'request_bytes': int(request.headers.get('content-length') or 0),
+      'request_id': _hash_id(request.url.params.get('request_id')),
+    }
+    started = time.monotonic()
+    try:
+      response = await self._inner.handle_async_request(request)
+      content = await response.aread()
+    except httpx.TransportError as exc:
+      entry['elapsed_ms'] = int((time.monotonic() - started) * 1000)
+      entry['error'] = type(exc).__name__
+      await asyncio.to_thread(self._append, entry)
+      raise
+    entry['elapsed_ms'] = int((time.monotonic() - started) * 1000)
+    entry['status_code'] = response.status_code
+    try:
+      body = json.loads(content)
+    except ValueError:
+      body = None
+    entry['body'] = _redact(body)
+    if isinstance(body, dict) and entry['kind'] == 'edit' and body.get('request_id'):
+      entry['request_id'] = _hash_id(body['request_id'])
+      entry['body']['request_id'] = entry['request_id']
+    await asyncio.to_thread(self._append, entry)
+    # aread() は展開済みの本文を返すので、圧縮・長さのヘッダーは付け直させる
+    headers = [
+      (name, value) for name, value in response.headers.multi_items()
+      if name.lower() not in _DECODED_BODY_HEADERS
+    ]
+    return httpx.Response(
+      response.status_code,
+      headers=headers,
+      content=content,
+      request=request,
+    )
+
+  async def aclose(self) -> None:
+    # クライアントは呼び出しごとに作り直すので、内側の接続プールは使い回す
+    pass
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+  """Serve recorded EternalAI traffic back with its original latency.
+
+  Each new edit request takes the next recorded edit (round-robin). A poll is
+  answered with the last recorded poll whose ``recorded_at`` offset from that
+  edit has passed, so time-to-result follows the recording regardless of how
+  often the client polls.
+  """
+
+  def __init__(self, path: str, speed: float = 1.0) -> None:
+    self._speed = speed if speed > 0 else 1.0
+    self._sessions = self._load(path)
+    if not self._sessions:
+      raise RuntimeError(f'No recorded EternalAI edit requests found in {path}')
+    self._next_session = itertools.cycle(self._sessions)
+    self._active: Dict[str, Dict[str, Any]] = {}
+
+  @staticmethod
+  def _load(path: str) -> List[Dict[str, Any]]:
+    polls: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+    edits: List[Dict[str, Any]] = []
+    with open(path, 'r', encoding='utf-8') as handle:
+      for line in handle:
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          continue
+        if entry.get('kind') == 'edit':
+          edits.append(entry)
+        else:
+          polls[entry.get('request_id')].append(entry)
+    sessions = []
+    for edit in edits:
+      edit_at = edit.get('recorded_at', 0)
+      timeline = sorted(
+        ((entry.get('recorded_at', 0) - edit_at, entry) for entry in polls.get(edit.get('request_id')) or []),
+        key=lambda item: item[0],
+      )
+      sessions.append({'edit': edit, 'polls': timeline})
+    return sessions
+
+  async def _respond(self, request: httpx.Request, entry: Dict[str, Any], body: Any) -> httpx.Response:
+    await asyncio.sleep(entry.get('elapsed_ms', 0) / 1000 / self._speed)
+    if entry.get('error'):
+      error_type = getattr(httpx, entry['error'], httpx.TransportError)
+      if not (isinstance(error_type, type) and issubclass(error_type, httpx.TransportError)):
+        error_type = httpx.TransportError
+      raise error_type(f"Replayed {entry['error']}", request=request)
+    return httpx.Response(entry.get('status_code', 200), json=body, request=request)
+
+  def _replay_body(self, body: Any) -> Any:
+    if isinstance(body, dict) and body.get('result_url') == REDACTED:
+      return {**body, 'result_url': _REPLAY_PLACEHOLDER}
+    return body
+
+  def _poll_entry(self, timeline: List[tuple], offset: float) -> tuple[Dict[str, Any], Any]:
+    entry = None
+    for recorded_offset, candidate in timeline:
+      if recorded_offset > offset:
+        break
+      entry = candidate
+    if entry is not None:
+      return entry, self._replay_body(entry.get('body'))
+
+    # 記録上の最初のポーリングより前: 最初の応答が処理中ならそれを、完了済みなら処理中を返す
+    first = timeline[0][1]
+    body = first.get('body')
+    if first.get('error') or (isinstance(body, dict) and body.get('status') in _TERMINAL_STATUSES):
+      return {'elapsed_ms': first.get('elapsed_ms', 0), 'status_code': 200}, {'status': 'processing'}
+    return first, body
+
+  def _prune(self, now: float) -> None:
+    expired = [key for key, state in self._active.items() if now - state['started'] > _REPLAY_STATE_TTL_SECONDS]
+    for key in expired:
+      del self._active[key]
+
+  async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+    now = time.monotonic()
+    if _kind(request) == 'edit':
+      self._prune(now)
+      session = next(self._next_session)
+      body = session['edit'].get('body')
+      if isinstance(body, dict) and body.get('request_id'):
+        replay_id = f'replay-{uuid4().hex}'
+        self._active[replay_id] = {'polls': session['polls'], 'started': now}
+        body = {**body, 'request_id': replay_id}
+      return await self._respond(request, session['edit'], body)
+
+    state = self._active.get(request.url.params.get('request_id', ''))
+    if state is None or not state['polls']:
+      return httpx.Response(404, json={'error': 'unknown request_id'}, request=request)
+    entry, body = self._poll_entry(state['polls'], (now - state['started']) * self._speed)
+    return await self._respond(request, entry, body)
+
+  async def aclose(self) -> None:
+    pass
+
+
+@lru_cache(maxsize=None)
+def _transport_for(mode: str, path: str, speed: float) -> Optional[httpx.AsyncBaseTransport]:
+  if mode == 'record':
+    logger.info("Recording EternalAI traffic to %s", path)
+    return RecordingTransport(path)
+  if mode == 'replay':
+    logger.info("Replaying EternalAI traffic from %s", path)
+    return ReplayTransport(path, speed)
+  return None
+
+
+def upstream_transport(settings: Settings) -> Optional[httpx.AsyncBaseTransport]:
+  """Transport for EternalAI calls: None (live), recorder or replayer depending on ETERNAL_AI_MODE."""
+
+  return _transport_for(
+    settings.eternal_ai_mode,
+    os.path.abspath(settings.eternal_ai_recording_path),
+    settings.eternal_ai_replay_speed,
+  )